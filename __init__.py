@@ -12,19 +12,88 @@
 
 
 from .save_image_extended import NODE_CLASS_MAPPINGS, NODE_DISPLAY_NAME_MAPPINGS
+from .save_image_extended import export_job_log, output_catalog, preview_cache, save_metrics, SaveImageExtended
 
 WEB_DIRECTORY = "./web"
 
 __all__ = ['NODE_CLASS_MAPPINGS', 'NODE_DISPLAY_NAME_MAPPINGS', "WEB_DIRECTORY"]
 
+import asyncio
+import folder_paths
 from aiohttp import web
 from server import PromptServer
 from pathlib import Path
 
 if hasattr(PromptServer, "instance"):
+  # jobs.jsonl of an output subfolder, exported in the legacy jobs.json shape: /save_image_extended/jobs?subfolder=v1-5-pruned
+  # with &save=true the export is also written as jobs.json next to it
+  async def export_jobs(request):
+    output_dir = Path(folder_paths.get_output_directory()).resolve()
+    folder = (output_dir / request.rel_url.query.get('subfolder', '')).resolve()
+    if not folder.is_relative_to(output_dir):
+      return web.Response(status=403)
+    jsonl_path = folder / 'jobs.jsonl'
+    if not jsonl_path.is_file():
+      return web.Response(status=404)
+    json_path = folder / 'jobs.json' if request.rel_url.query.get('save') == 'true' else None
+    return web.json_response(export_job_log(jsonl_path, json_path))
+
+  # preview_only images, kept in memory: /save_image_extended/preview/<key>
+  async def get_preview(request):
+    entry = preview_cache.get(request.match_info['key'])
+    if entry is None:
+      return web.Response(status=404)
+    return web.Response(body=entry['display'], content_type=entry['content_type'], headers={'Cache-Control': 'no-store'})
+
+  # writes preview_only images to disk: POST {"keys": [...]}, answers the saved images like ui.images
+  # the copies run in an executor, not on the event loop
+  async def persist_previews(request):
+    try:
+      body = await request.json()
+    except ValueError:
+      return web.Response(status=400)
+    keys = body.get('keys', []) if isinstance(body, dict) else None
+    if not isinstance(keys, list) or not all(isinstance(key, str) for key in keys):
+      return web.Response(status=400)
+    try:
+      images = await asyncio.get_running_loop().run_in_executor(None, SaveImageExtended().persistPreviews, keys)
+    except OSError as e:
+      return web.json_response({'error': str(e)}, status=500)
+    return web.json_response({'images': images})
+
+  # time of each save stage, images and bytes written: /save_image_extended/metrics as json, ?format=prometheus for a scraper
+  async def get_metrics(request):
+    if request.rel_url.query.get('format') == 'prometheus':
+      return web.Response(text=save_metrics.prometheus(), content_type='text/plain', headers={'X-Content-Type-Options': 'nosniff'}, charset='utf-8')
+    return web.json_response(save_metrics.snapshot())
+
+  # saved images, newest first: /save_image_extended/catalog?seed=42&checkpoint=v1-5-pruned.safetensors&limit=20
+  # filters: seed steps cfg sampler_name scheduler checkpoint format, lora prompt (contains), subfolder, since until (ISO timestamps)
+  async def query_catalog(request):
+    node = SaveImageExtended()
+    db_path = Path(node.output_dir) / node.catalog_name
+    if not db_path.is_file():
+      return web.Response(status=404)
+    query = request.rel_url.query
+    try:
+      limit = min(int(query.get('limit', 100)), 1000)
+      offset = int(query.get('offset', 0))
+      rows = output_catalog.query(db_path.as_posix(), query, limit, offset)
+    except ValueError:
+      return web.Response(status=400)
+    return web.json_response({'images': rows, 'limit': limit, 'offset': offset})
+
+  # NOTE: routes go before the static path, that would answer 404 for them
+  PromptServer.instance.app.add_routes([
+    web.get("/save_image_extended/jobs", export_jobs),
+    web.get("/save_image_extended/metrics", get_metrics),
+    web.get("/save_image_extended/catalog", query_catalog),
+    web.post("/save_image_extended/preview/persist", persist_previews),
+    web.get("/save_image_extended/preview/{key}", get_preview),
+  ])
+
   # NOTE: we add an extra static path to avoid comfy mechanism
   # that loads every script in web.
   PromptServer.instance.app.add_routes(
       [web.static("/save_image_extended", (Path(__file__).parent.absolute() / "assets").as_posix())]
   )
-
@@ -0,0 +1,327 @@
+# Benchmark of the save pipeline, no GPU and no ComfyUI needed: folder_paths is stubbed, images are synthetic tensors.
+# Runs the same steps as save_images, stage by stage, then save_images itself:
+#
+#   python benchmark.py                 # every output_ext, 512/1024/2048px, batch 1/4, quality 75/90/100, folders of 10k/100k files, jobs.json of 1k/10k jobs
+#   python benchmark.py --quick         # smaller matrix, for a quick before/after
+#   python benchmark.py --exts .webp,.png --sizes 1024 --qualities 90 --json bench.json
+#
+# Times are the best of --repeat runs, in milliseconds. Each case runs in its own python process, and its peak memory is
+# how much that process' peak RSS grew during the case: torch storage, numpy buffers and the encoders' C allocations
+# all count. Output sizes are the bytes written per image.
+
+import os
+import sys
+import json
+import time
+import types
+import shutil
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime, timedelta
+
+import numpy
+
+try:
+  import resource
+except ImportError:
+  # Windows: no peak memory
+  resource = None
+
+work_dir = tempfile.mkdtemp(prefix='save_image_extended_bench_')
+
+# save_image_extended only needs those two from ComfyUI
+folder_paths = types.ModuleType('folder_paths')
+folder_paths.get_output_directory = lambda: os.path.join(work_dir, 'output')
+folder_paths.get_temp_directory = lambda: os.path.join(work_dir, 'temp')
+sys.modules.setdefault('folder_paths', folder_paths)
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import save_image_extended as sie
+from PIL import Image
+
+try:
+  import torch
+except ImportError:
+  # images_to_uint8 takes numpy arrays as well
+  torch = None
+
+
+# a txt2img + lora + upscale workflow, the kind of prompt save_images usually gets
+prompt = {
+  '3': {'class_type': 'KSampler', 'inputs': {'seed': 123456789, 'steps': 30, 'cfg': 7.5, 'sampler_name': 'dpmpp_2m', 'scheduler': 'karras', 'denoise': 1.0, 'model': ['10', 0], 'positive': ['6', 0], 'negative': ['7', 0], 'latent_image': ['5', 0]}},
+  '4': {'class_type': 'CheckpointLoaderSimple', 'inputs': {'ckpt_name': 'SDXL/juggernautXL_v9.safetensors'}},
+  '5': {'class_type': 'EmptyLatentImage', 'inputs': {'width': 1024, 'height': 1024, 'batch_size': 1}},
+  '6': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'a photo of a hippo wearing a floppy disk hat, ' * 8, 'clip': ['10', 1]}},
+  '7': {'class_type': 'CLIPTextEncode', 'inputs': {'text': 'blurry, lowres, watermark', 'clip': ['10', 1]}},
+  '8': {'class_type': 'VAEDecode', 'inputs': {'samples': ['3', 0], 'vae': ['11', 0]}},
+  '10': {'class_type': 'LoraLoader', 'inputs': {'lora_name': 'styles/film_grain.safetensors', 'strength_model': 0.8, 'strength_clip': 0.8, 'model': ['4', 0], 'clip': ['4', 1]}},
+  '11': {'class_type': 'VAELoader', 'inputs': {'vae_name': 'sdxl_vae.safetensors'}},
+  '12': {'class_type': 'UpscaleModelLoader', 'inputs': {'model_name': '4x-UltraSharp.pth'}},
+}
+extra_pnginfo = {'workflow': {'nodes': [{'id': i, 'type': 'Node', 'pos': [i * 10, i * 20], 'size': [300, 200], 'widgets_values': ['x' * 40] * 4} for i in range(40)], 'links': [[i, i, 0, i + 1, 0, 'MODEL'] for i in range(40)], 'version': 0.4}}
+
+filename_keys = 'sampler_name, cfg, steps, %F'
+foldername_keys = 'ckpt_name'
+delimiter = '-'
+counter_digits = 4
+counter_position = 'last'
+save_job_data = 'basic, models, sampler, prompt'
+
+
+# smooth gradients plus some grain: pure noise does not compress like a generated picture, and makes libjpeg fail with optimize=True
+def gen_images(batch, size):
+  rng = numpy.random.default_rng(0)
+  ramp = numpy.linspace(0, 1, size, dtype=numpy.float32)
+  images = numpy.empty((batch, size, size, 3), dtype=numpy.float32)
+  for i in range(batch):
+    images[i, ..., 0] = ramp[None, :]
+    images[i, ..., 1] = ramp[:, None]
+    images[i, ..., 2] = (ramp[None, :] + ramp[:, None] + i / batch) % 1
+  images = numpy.clip(images + rng.normal(0, 0.03, images.shape).astype(numpy.float32), 0, 1)
+  return torch.from_numpy(images) if torch is not None else images
+
+
+def best_of(repeat, fn):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    result = fn()
+    elapsed = (time.perf_counter() - start) * 1000
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def reset_state():
+  sie.counter_index.folders.clear()
+
+
+# peak RSS of this process so far, in bytes: ru_maxrss is in KB on Linux, in bytes on macOS
+def peak_rss():
+  if resource is None: return None
+  rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return rss if sys.platform == 'darwin' else rss * 1024
+
+
+# ███████ ████████  █████   ██████  ███████ ███████
+# ██         ██    ██   ██ ██       ██      ██
+# ███████    ██    ███████ ██   ███ █████   ███████
+#      ██    ██    ██   ██ ██    ██ ██           ██
+# ███████    ██    ██   ██  ██████  ███████ ███████
+
+# one save, stage by stage, the same calls save_images makes
+def bench_stages(node, images, output_ext, quality, repeat):
+  output_root = os.path.join(work_dir, 'output', 'stages')
+  shutil.rmtree(output_root, ignore_errors=True)
+  timings = {}
+
+  timings['convert'], frames = best_of(repeat, lambda: sie.images_to_uint8(images))
+  resolution = f'{frames.shape[2]}x{frames.shape[1]}'
+  timestamp = datetime.now()
+
+  def names():
+    prompt_index = sie.PromptIndex(prompt, node.cleanup_fileName)
+    foldername = node.generate_custom_name(foldername_keys, '', delimiter, prompt, resolution, timestamp, prompt_index=prompt_index)
+    filename = node.generate_custom_name(filename_keys, 'ComfyUI', delimiter, prompt, resolution, timestamp, prompt_index=prompt_index)
+    return prompt_index, foldername, filename
+  timings['names'], (prompt_index, foldername, filename) = best_of(repeat, names)
+
+  output_path = os.path.join(output_root, foldername)
+  os.makedirs(output_path, exist_ok=True)
+  def counter():
+    reset_state()
+    return node.get_latest_counter(output_path, filename, counter_digits, counter_position, output_ext)
+  timings['counter'], counter = best_of(repeat, counter)
+
+  timings['metadata'], kwargs = best_of(repeat, lambda: node.genEncoderKwargs(output_ext, None, prompt, True, extra_pnginfo, quality))
+
+  image_paths = [os.path.join(output_path, node.genImageName(filename, 'ComfyUI', delimiter, counter + i, counter_digits, counter_position, output_ext)) for i in range(len(frames))]
+  def write():
+    for frame, image_path in zip(frames, image_paths):
+      node.writeImage(image_path, Image.fromarray(frame), prompt, True, extra_pnginfo, quality, kwargs)
+  timings['write'], _ = best_of(repeat, write)
+
+  def job():
+    node.save_job_to_json(save_job_data, prompt, 'ComfyUI', None, None, '', resolution, output_path, 'jobs.json', timestamp, prompt_index)
+  timings['job'], _ = best_of(repeat, job)
+
+  size = sum(os.path.getsize(image_path) for image_path in image_paths) // len(image_paths)
+  shutil.rmtree(output_root, ignore_errors=True)
+  return timings, size
+
+
+# the whole node, as ComfyUI calls it
+def bench_save_images(node, images, output_ext, quality, repeat, **kwargs):
+  args = dict(filename_prefix='ComfyUI', filename_keys=filename_keys, foldername_prefix='', foldername_keys=foldername_keys, delimiter=delimiter,
+    save_job_data=save_job_data, job_data_per_image=False, job_custom_text='', save_metadata=True, counter_digits=counter_digits, counter_position=counter_position,
+    one_counter_per_folder=True, image_preview=True, output_ext=output_ext, quality=quality, named_keys=False, prompt=prompt, extra_pnginfo=extra_pnginfo)
+  args.update(kwargs)
+  elapsed, _ = best_of(repeat, lambda: node.save_images(images, **args))
+  sie.flush_async_writer()
+  return elapsed
+
+
+# ███████  ██████  █████  ██      ███████
+# ██      ██      ██   ██ ██      ██
+# ███████ ██      ███████ ██      █████
+#      ██ ██      ██   ██ ██      ██
+# ███████  ██████ ██   ██ ███████ ███████
+
+# a folder that already holds n images: first counter lookup (listdir) and the next ones
+def bench_folder(node, n, repeat):
+  output_path = os.path.join(work_dir, 'output', 'scale')
+  shutil.rmtree(output_path, ignore_errors=True)
+  os.makedirs(output_path)
+  filename = 'ComfyUI-euler-8.0-20'
+  for i in range(1, n + 1):
+    open(os.path.join(output_path, f'{filename}-{i:06}.png'), 'w').close()
+
+  def cold():
+    reset_state()
+    return node.get_latest_counter(output_path, filename, 6, 'last', '.png')
+  cold_ms, counter = best_of(repeat, cold)
+  assert counter == n + 1, f'counter {counter} != {n + 1}'
+  warm_ms, _ = best_of(repeat, lambda: node.get_latest_counter(output_path, filename, 6, 'last', '.png'))
+  shutil.rmtree(output_path, ignore_errors=True)
+  return {'files': n, 'counter_cold': cold_ms, 'counter_warm': warm_ms}
+
+
+# a jobs.json / jobs.jsonl that already holds n jobs: cost of adding one more
+def bench_jobs(node, n, repeat):
+  output_path = os.path.join(work_dir, 'output', 'jobs')
+  shutil.rmtree(output_path, ignore_errors=True)
+  os.makedirs(output_path)
+  prompt_index = sie.PromptIndex(prompt, node.cleanup_fileName)
+  start = datetime(2020, 1, 1)
+  # one real entry, copied n times with distinct timestamps
+  node.save_job_to_json(save_job_data, prompt, 'ComfyUI', None, None, '', '1024x1024', output_path, 'jobs.json', start, prompt_index)
+  with open(os.path.join(output_path, 'jobs.json')) as f:
+    job = next(iter(json.load(f).values()))
+  jobs = {(start + timedelta(minutes=i)).strftime('%c'): job for i in range(n)}
+  with open(os.path.join(output_path, 'jobs.json'), 'w') as f:
+    json.dump(jobs, f, indent=4)
+  with open(os.path.join(output_path, 'jobs.jsonl'), 'w') as f:
+    for timestamp in jobs:
+      f.write(json.dumps({'timestamp': timestamp, 'job': job}) + '\n')
+
+  result = {'jobs': n, 'json_bytes': os.path.getsize(os.path.join(output_path, 'jobs.json'))}
+  for job_filename in ['jobs.json', 'jobs.jsonl']:
+    # a new timestamp each time, or jobs.json would just overwrite the same key
+    timestamps = iter(datetime(2030, 1, 1) + timedelta(minutes=i) for i in range(repeat))
+    result[job_filename], _ = best_of(repeat, lambda: node.save_job_to_json(save_job_data, prompt, 'ComfyUI', None, None, '', '1024x1024', output_path, job_filename, next(timestamps), prompt_index))
+  shutil.rmtree(output_path, ignore_errors=True)
+  return result
+
+
+# one ext/size/batch/quality case, run by a child process started by run_case: prints its results as json
+def bench_case(output_ext, size, batch, quality, repeat):
+  node = sie.SaveImageExtended()
+  sie.load_codec(output_ext)
+  images = gen_images(batch, size)
+  start = peak_rss()
+  try:
+    timings, image_size = bench_stages(node, images, output_ext, quality, repeat)
+    total = bench_save_images(node, images, output_ext, quality, repeat)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+  peak = None if start is None else peak_rss() - start
+  print(json.dumps({'ms': timings, 'bytes_per_image': image_size, 'peak_bytes': peak, 'save_images_ms': total}))
+
+
+# a fresh process per case, so the peak RSS of one case does not hide the next one
+def run_case(output_ext, size, batch, quality, repeat):
+  case = subprocess.run([sys.executable, os.path.abspath(__file__), '--case', f'{output_ext},{size},{batch},{quality}', '--repeat', str(repeat)],
+    capture_output=True, text=True)
+  if case.returncode != 0:
+    lines = case.stderr.strip().splitlines()
+    raise RuntimeError(lines[-1] if lines else f'exit code {case.returncode}')
+  return json.loads(case.stdout.strip().splitlines()[-1])
+
+
+def csv_ints(value):
+  return [int(v) for v in value.split(',') if v.strip()]
+
+def csv_exts(value):
+  return [v.strip() if v.strip().startswith('.') else f'.{v.strip()}' for v in value.split(',') if v.strip()]
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Benchmark of the SaveImageExtended save pipeline')
+  parser.add_argument('--quick', action='store_true', help='small matrix: webp/png/jpg, 512px, batch 1/4, quality 90, 10k files, 1k jobs')
+  parser.add_argument('--exts', type=csv_exts, help='comma separated output_ext, default: every supported one')
+  parser.add_argument('--sizes', type=csv_ints, help='comma separated square sizes in pixels')
+  parser.add_argument('--batches', type=csv_ints, help='comma separated batch sizes')
+  parser.add_argument('--qualities', type=csv_ints, help='comma separated quality values')
+  parser.add_argument('--folder-files', type=csv_ints, help='comma separated number of files already in the folder')
+  parser.add_argument('--jobs', type=csv_ints, help='comma separated number of jobs already in jobs.json')
+  parser.add_argument('--repeat', type=int, default=3, help='runs per measure, the best is kept')
+  parser.add_argument('--json', help='also write the results in this json file')
+  parser.add_argument('--case', help=argparse.SUPPRESS)
+  args = parser.parse_args()
+
+  if args.case:
+    output_ext, size, batch, quality = args.case.split(',')
+    return bench_case(output_ext, int(size), int(batch), int(quality), args.repeat)
+
+  if args.quick:
+    defaults = dict(exts=['.webp', '.png', '.jpg'], sizes=[512], batches=[1, 4], qualities=[90], folder_files=[10000], jobs=[1000])
+  else:
+    defaults = dict(exts=sie.SaveImageExtended.output_exts, sizes=[512, 1024, 2048], batches=[1, 4], qualities=[75, 90, 100], folder_files=[10000, 100000], jobs=[1000, 10000])
+  for name, value in defaults.items():
+    if getattr(args, name) is None: setattr(args, name, value)
+
+  node = sie.SaveImageExtended()
+  exts = list()
+  for ext in args.exts:
+    try:
+      # AVIF/JXL plugins are only imported when needed
+      sie.load_codec(ext)
+    except OSError:
+      print(f'skipped {ext}: plugin cannot be loaded')
+      continue
+    if ext not in Image.registered_extensions():
+      print(f'skipped {ext}: no Pillow encoder')
+      continue
+    exts.append(ext)
+
+  results = {'version': sie.version, 'torch': torch is not None, 'stages': [], 'save_images': [], 'folders': [], 'jobs': []}
+  stages = ['convert', 'names', 'counter', 'metadata', 'write', 'job']
+
+  print(f"\n{'ext':6} {'size':>5} {'batch':>5} {'qual':>4} " + ' '.join(f'{s:>9}' for s in stages) + f" {'save_img':>9} {'bytes/img':>10} {'peak MB':>8}")
+  try:
+    for output_ext in exts:
+      for size in args.sizes:
+        for batch in args.batches:
+          for quality in args.qualities:
+            try:
+              case = run_case(output_ext, size, batch, quality, args.repeat)
+            except Exception as e:
+              print(f'{output_ext:6} {size:5} {batch:5} {quality:4} error: {e}')
+              continue
+            timings, image_size, peak, total = case['ms'], case['bytes_per_image'], case['peak_bytes'], case['save_images_ms']
+            peak_mb = f'{peak / 2**20:8.1f}' if peak is not None else f"{'-':>8}"
+            print(f'{output_ext:6} {size:5} {batch:5} {quality:4} ' + ' '.join(f'{timings[s]:9.2f}' for s in stages) + f' {total:9.2f} {image_size:10} {peak_mb}')
+            results['stages'].append({'ext': output_ext, 'size': size, 'batch': batch, 'quality': quality, 'ms': timings, 'bytes_per_image': image_size, 'peak_bytes': peak})
+            results['save_images'].append({'ext': output_ext, 'size': size, 'batch': batch, 'quality': quality, 'ms': total})
+
+    print(f"\n{'files':>7} {'counter cold':>13} {'counter warm':>13}")
+    for n in args.folder_files:
+      folder = bench_folder(node, n, args.repeat)
+      print(f"{n:7} {folder['counter_cold']:13.2f} {folder['counter_warm']:13.3f}")
+      results['folders'].append(folder)
+
+    print(f"\n{'jobs':>7} {'jobs.json MB':>13} {'append json':>12} {'append jsonl':>13}")
+    for n in args.jobs:
+      jobs = bench_jobs(node, n, args.repeat)
+      print(f"{n:7} {jobs['json_bytes'] / 2**20:13.1f} {jobs['jobs.json']:12.2f} {jobs['jobs.jsonl']:13.3f}")
+      results['jobs'].append(jobs)
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+  if args.json:
+    with open(args.json, 'w') as f:
+      json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+  main()
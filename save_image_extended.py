@@ -1,9 +1,38 @@
 import os
 import re
 import sys
+import io
 import json
+import uuid
+import hashlib
+import sqlite3
+import tarfile
+import zipfile
+import zlib
+import struct
+import contextlib
+import base64
+import atexit
 import locale
+import importlib
+import importlib.util
+import importlib.metadata
+import mimetypes
+import time
+import threading
+import queue
+from functools import lru_cache
+import multiprocessing
+try:
+  import fcntl
+except ImportError:
+  # Windows
+  fcntl = None
+  import msvcrt
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
 from datetime import datetime
+from collections import OrderedDict, deque
 from pathlib import Path
 import folder_paths
 
@@ -16,42 +45,1223 @@ import numpy
 
 version = 2.86
 
-avif_supported = False
-jxl_supported = False
-
 debug = False
 # debug = True
 
-# Avif is included in requirements.txt
-try:
-  import pillow_avif
-except:
-  print(f"\033[92m[💾 save_image_extended]\033[0m AVIF is not supported. To add it: pip install pillow pillow-avif-plugin\033[0m") 
-  pass
-else:
+# optional codecs ---------------------------------------------------------------------------------------
+# AVIF and JXL come from Pillow plugins. Importing them loads native libraries, so that waits for the first image saved in that format.
+# At startup we only look whether the plugin is installed (find_spec, nothing is imported). Whether the import really works is
+# remembered in codec_probe_file, keyed by the installed versions: a broken plugin is not offered again until something is (re)installed.
+# Avif is included in requirements.txt. Jxl requires jxlpy wheel to be compiled, and a valid MSVC environment, which is complex task
+codec_plugins = {
+  '.avif': ('pillow_avif', 'pillow-avif-plugin'),
+  '.jxl':  ('pillow_jxl', 'pillow-jxl-plugin'),
+}
+codec_probe_file = os.path.join(os.path.dirname(os.path.realpath(__file__)), '.codec_probe.json')
+codecs_loaded = {}
+codecs_lock = threading.Lock()
+
+def dist_version(dist):
+  try:
+    return importlib.metadata.version(dist)
+  except importlib.metadata.PackageNotFoundError:
+    return None
+
+def probe_codecs():
+  versions = {'python': sys.version, 'pillow': dist_version('pillow')}
+  versions.update({ext: dist_version(dist) for ext, (module, dist) in codec_plugins.items()})
+  try:
+    with open(codec_probe_file, 'r') as f:
+      probe = json.load(f)
+    if probe.get('versions') == versions:
+      return probe['codecs'], versions
+  except (OSError, ValueError, KeyError):
+    pass
+  return {ext: importlib.util.find_spec(module) is not None for ext, (module, dist) in codec_plugins.items()}, versions
+
+codecs_supported, codecs_versions = probe_codecs()
+
+# imports the plugin of output_ext the first time it is needed. Raises OSError when it cannot be loaded
+def load_codec(output_ext):
+  if output_ext not in codec_plugins or codecs_loaded.get(output_ext): return
+  with codecs_lock:
+    if output_ext not in codecs_loaded:
+      try:
+        importlib.import_module(codec_plugins[output_ext][0])
+        codecs_loaded[output_ext] = True
+      except Exception as e:
+        print(f"SaveImageExtended {version} error: {codec_plugins[output_ext][1]} cannot be loaded: {e}")
+        codecs_loaded[output_ext] = False
+      if codecs_supported.get(output_ext) != codecs_loaded[output_ext]:
+        codecs_supported[output_ext] = codecs_loaded[output_ext]
+        try:
+          with open(codec_probe_file, 'w') as f:
+            json.dump({'versions': codecs_versions, 'codecs': codecs_supported}, f)
+        except OSError:
+          pass
+  if not codecs_loaded[output_ext]:
+    raise OSError(f"{output_ext} is not supported, {codec_plugins[output_ext][1]} cannot be loaded")
+
+avif_supported = codecs_supported['.avif']
+jxl_supported = codecs_supported['.jxl']
+
+if avif_supported:
   print(f"\033[92m[💾 save_image_extended] AVIF   is supported! Woohoo!\033[0m") 
-  avif_supported = True
+else:
+  print(f"\033[92m[💾 save_image_extended]\033[0m AVIF is not supported. To add it: pip install pillow pillow-avif-plugin\033[0m") 
 
-# Jxl requires jxlpy wheel to be compiled, and a valid MSVC environment, which is complex task
-try:
+if jxl_supported:
+  print(f"\033[92m[💾 save_image_extended] JPEGXL is supported! YeePee!\033[0m") 
+else:
   # jxlpy is in early stages of development. None one has ever compiled it on Windows AFAIK
   # from jxlpy import JXLImagePlugin
   # from imagecodecs import (jpegxl_encode, jpegxl_decode, jpegxl_check, jpegxl_version, JPEGXL)
-  import pillow_jxl
-except:
   print(f"\033[92m[💾 save_image_extended]\033[0m JXL is not supported. To add it: pip install jxlpy\033[0m") 
   print(f"\033[92m[💾 save_image_extended]\033[0m                       You will need a valid MSVC env to build the wheel\033[0m") 
-  pass
-else:
-  print(f"\033[92m[💾 save_image_extended] JPEGXL is supported! YeePee!\033[0m") 
-  jxl_supported = True
 
-# PIL must be loaded after pillow plugins
+# pillow plugins register themselves in PIL when load_codec imports them
 from PIL import Image, ExifTags
 from PIL.PngImagePlugin import PngInfo
 
 sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), 'comfy'))
-original_locale = locale.setlocale(locale.LC_TIME, '')
+
+# LC_TIME of the environment, for %c %A %B... in names and jobs.json. setlocale is process-wide: done on the first date formatting, not at import
+time_locale_set = False
+
+def set_time_locale():
+  global time_locale_set
+  if time_locale_set: return
+  time_locale_set = True
+  try:
+    locale.setlocale(locale.LC_TIME, '')
+  except locale.Error:
+    pass
+
+
+# Converts the whole IMAGE batch (float 0-1, batch x height x width x channels) to uint8 in one vectorized operation.
+# Quantization happens on the tensor's own device, so only a quarter of the bytes cross to the host, and there is
+# no float32 copy of the batch on the CPU. float to uint8 truncates after the clamp, exactly like numpy astype did.
+def images_to_uint8(images):
+  if isinstance(images, numpy.ndarray):
+    # API callers may hand us numpy arrays
+    return numpy.clip(255. * images, 0, 255).astype(numpy.uint8)
+  return images.mul(255.).clamp_(0, 255).byte().contiguous().cpu().numpy()
+
+
+# class FrameStream -------------------------------------------------------------------------------------
+# Used when SaveImageExtended.stream_frames is reached: the batch is converted one frame at a time by a producer thread,
+# up to depth frames ahead of the encoder, instead of all at once. The device to host copy and quantization of the next frames
+# run while the current one is encoded and written, and host memory stays the same for 10 or 10000 frames.
+# Stands for the uint8 batch in save_images: shape, len() and one pass of iteration.
+class FrameStream:
+  def __init__(self, images, depth=4):
+    self.images = images
+    self.shape = tuple(images.shape)
+    self.queue = queue.Queue(maxsize=max(depth, 1))
+    self.stopped = threading.Event()
+  
+  def __len__(self):
+    return self.shape[0]
+  
+  # False once the consumer is gone
+  def put(self, item):
+    while not self.stopped.is_set():
+      try:
+        self.queue.put(item, timeout=0.1)
+        return True
+      except queue.Full:
+        pass
+    return False
+  
+  def produce(self):
+    try:
+      for index in range(len(self)):
+        if not self.put(images_to_uint8(self.images[index:index + 1])[0]): return
+    except Exception as e:
+      self.put(e)
+  
+  def __iter__(self):
+    threading.Thread(target=self.produce, name='save_image_extended_stream', daemon=True).start()
+    try:
+      for _ in range(len(self)):
+        frame = self.queue.get()
+        if isinstance(frame, Exception): raise frame
+        yield frame
+    finally:
+      self.stopped.set()
+
+
+# large images ------------------------------------------------------------------------------------------
+# Used when SaveImageExtended.large_image_pixels is reached: after a 4x/8x upscale, a float intermediate of the whole frame
+# plus a full PIL image would cost several GB. The frame stays a tensor and is converted rows strips at a time.
+def frame_strips(frame, rows):
+  for top in range(0, frame.shape[0], rows):
+    yield images_to_uint8(frame[top:top + rows])
+
+# the whole uint8 frame, without the float intermediate of the whole frame
+def frame_to_uint8(frame, rows):
+  converted = numpy.empty(tuple(frame.shape), dtype=numpy.uint8)
+  top = 0
+  for strip in frame_strips(frame, rows):
+    converted[top:top + len(strip)] = strip
+    top += len(strip)
+  return converted
+
+# PNG written strip by strip: the Up filter is done with numpy, zlib compresses as the rows come, IDAT chunks follow.
+# pnginfo chunks are copied as Pillow would write them
+def write_png_strips(f, frame, rows, compress_level=6, pnginfo=None):
+  height, width, channels = frame.shape
+  def chunk(cid, data):
+    f.write(struct.pack('>I', len(data)) + cid + data + struct.pack('>I', zlib.crc32(cid + data)))
+  chunks = pnginfo.chunks if pnginfo is not None else []
+  f.write(b'\x89PNG\r\n\x1a\n')
+  chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, {1: 0, 2: 4, 3: 2, 4: 6}[channels], 0, 0, 0))
+  for cid, data, after_idat in chunks:
+    if not after_idat: chunk(cid, data)
+  compressor = zlib.compressobj(compress_level)
+  previous = numpy.zeros((1, width * channels), dtype=numpy.uint8)
+  for strip in frame_strips(frame, rows):
+    strip = strip.reshape(len(strip), width * channels)
+    filtered = numpy.empty((len(strip), width * channels + 1), dtype=numpy.uint8)
+    # filter type 2 = Up: each byte minus the one above, modulo 256
+    filtered[:, 0] = 2
+    numpy.subtract(strip, numpy.concatenate((previous, strip[:-1])), out=filtered[:, 1:])
+    previous = strip[-1:]
+    data = compressor.compress(filtered)
+    if data: chunk(b'IDAT', data)
+  chunk(b'IDAT', compressor.flush())
+  for cid, data, after_idat in chunks:
+    if after_idat: chunk(cid, data)
+  chunk(b'IEND', b'')
+
+# large TIFF without tifffile: Pillow writes it from one uint8 copy of the frame. Said once, not for every image
+tifffile_warned = False
+
+def tifffile_available():
+  global tifffile_warned
+  if importlib.util.find_spec('tifffile') is not None: return True
+  if not tifffile_warned:
+    tifffile_warned = True
+    print(f"SaveImageExtended {version} info: large TIFF images are written by Pillow in one piece. To write them tile by tile: pip install tifffile")
+  return False
+
+# tiled TIFF with tifffile, deflate compressed, one row of tiles converted at a time. Edge tiles are padded, as TIFF wants
+def write_tiff_tiles(f, frame, tile):
+  import tifffile
+  height, width, channels = frame.shape
+  def tiles():
+    for strip in frame_strips(frame, tile):
+      for left in range(0, width, tile):
+        block = strip[:, left:left + tile]
+        if block.shape[:2] != (tile, tile):
+          block = numpy.pad(block, ((0, tile - block.shape[0]), (0, tile - block.shape[1]), (0, 0)))
+        yield block
+  with tifffile.TiffWriter(f, bigtiff=height * width * channels > 2**31) as tiff:
+    tiff.write(tiles(), shape=(height, width, channels), dtype=numpy.uint8, tile=(tile, tile), photometric='rgb' if channels >= 3 else 'minisblack', compression='zlib')
+
+
+# Counter found in file for this filename/output_ext/counter_position. None = file does not belong to that counter, 0 = no counter in it
+#   file[:counter_digits] = '0001'
+#   file[counter_digits +1:] = 'webp'
+def file_counter(file, filename, counter_digits, counter_position, output_ext):
+  if not file.endswith(output_ext):
+    return None
+  # '.webp' = 5
+  extLen = len(output_ext)
+  
+  # issue/48 needs a special case for files, counter_position does not matter here, but the filename length does
+  if not filename:
+    return int(file[:counter_digits]) if (file[:counter_digits].isdecimal() and len(file)==(counter_digits+extLen)) else 0
+  if counter_position == 'last':
+    if not file.startswith(filename): return None
+    return int(file[-(extLen + counter_digits):-extLen]) if file[-(extLen + counter_digits):-extLen].isdecimal() else 0
+  if not file[counter_digits +1:].startswith(filename): return None
+  return int(file[:counter_digits]) if file[:counter_digits].isdecimal() else 0
+
+
+# atomic writes -----------------------------------------------------------------------------------------
+# Files are encoded in memory, written in one go to a hidden temp file next to them, then renamed over the final name:
+# a crash or a kill leaves the previous file or no file, never a truncated one. Network storage also prefers one big write
+# to the many small ones of an encoder. SaveImageExtended.durability adds the fsyncs.
+def encode_image(img, output_ext, kwargs, **save_kwargs):
+  load_codec(output_ext)
+  buffer = io.BytesIO()
+  img.save(buffer, format=Image.registered_extensions()[output_ext], **kwargs, **save_kwargs)
+  return buffer.getvalue()
+
+def write_file_atomic(path, data, fsync=False):
+  with atomic_file(path, fsync) as f:
+    f.write(data)
+
+# the file object of a temp file, renamed over path once the block ends without error. For encoders that write as they go
+@contextlib.contextmanager
+def atomic_file(path, fsync=False):
+  path = str(path)
+  # hidden and not ending with output_ext: the counter never sees it
+  temp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp')
+  fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666)
+  try:
+    with os.fdopen(fd, 'wb') as f:
+      yield f
+      if fsync:
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+  except BaseException:
+    try:
+      os.unlink(temp_path)
+    except OSError:
+      pass
+    raise
+
+# durability = 'fsync+dir': the renames are only durable once their folder is flushed too
+def fsync_folders(paths):
+  for folder_path in {os.path.dirname(str(path)) for path in paths}:
+    try:
+      fd = os.open(folder_path, os.O_RDONLY)
+    except OSError:
+      # Windows cannot open a folder, NTFS journals the rename anyway
+      continue
+    try:
+      os.fsync(fd)
+    except OSError:
+      pass
+    finally:
+      os.close(fd)
+
+
+# encode pool -------------------------------------------------------------------------------------------
+# Used when SaveImageExtended.parallel_encode = True: AVIF/JXL/WebP encodes are CPU bound, so a batch is spread over every core.
+# The pool is created once per process and stays warm. Frames go through shared memory, not pickle:
+# the workers only receive the shared memory name, the batch shape and their frame index.
+# fork is required: ComfyUI loads custom nodes by file location, a spawned worker could not import this module back.
+# Where fork is not available (Windows) the pool falls back to threads, Pillow encoders release the GIL anyway.
+# Forking a process that runs threads (ComfyUI's server, CUDA, the async writer) only copies the forking thread: a lock
+# held by another thread at that moment stays locked forever in the child. The workers must not take any lock of this module:
+# the codec is loaded by the parent before the frames are submitted, and codecs_lock is renewed in every child.
+encode_pool = None
+encode_pool_lock = threading.Lock()
+
+def get_encode_pool(max_workers=0):
+  global encode_pool
+  with encode_pool_lock:
+    if encode_pool is None:
+      max_workers = max_workers or os.cpu_count() or 1
+      if 'fork' in multiprocessing.get_all_start_methods():
+        encode_pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('fork'))
+      else:
+        encode_pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='save_image_extended_encode')
+    return encode_pool
+
+if hasattr(os, 'register_at_fork'):
+  def renew_codecs_lock():
+    global codecs_lock
+    codecs_lock = threading.Lock()
+  os.register_at_fork(after_in_child=renew_codecs_lock)
+
+@atexit.register
+def shutdown_encode_pool():
+  if encode_pool is not None:
+    encode_pool.shutdown(wait=True)
+
+# runs in the pool: frame #index of the uint8 batch stored in shared memory shm_name
+def encode_shared_frame(shm_name, shape, index, image_path, kwargs, fsync=False):
+  shm = shared_memory.SharedMemory(name=shm_name)
+  try:
+    frame_size = int(numpy.prod(shape[1:]))
+    frame = numpy.ndarray(shape[1:], dtype=numpy.uint8, buffer=shm.buf, offset=index * frame_size)
+    start = time.perf_counter()
+    img = Image.fromarray(frame)
+    data = encode_image(img, Path(image_path).suffix, kwargs)
+    # RGBA and L images map the buffer, nothing may point to it when we close
+    del img, frame
+    write_file_atomic(image_path, data, fsync)
+    # the worker may be another process: its timing goes back to save_metrics with the result
+    return time.perf_counter() - start, len(data)
+  finally:
+    try:
+      shm.close()
+    except BufferError:
+      pass
+
+
+# class SaveMetrics -------------------------------------------------------------------------------------
+# Time spent in each stage of save_images and what was written, since ComfyUI started. Served by /save_image_extended/metrics.
+# Histograms are cumulative like Prometheus ones; percentiles come from the last `window` observations of each stage.
+# 'encode' is one observation per image, measured where the image is encoded: in the node, the async writer or the encode pool.
+class SaveMetrics:
+  stages = ['convert', 'names', 'counter', 'metadata', 'write', 'job', 'preview', 'total', 'encode']
+  buckets = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+  
+  def __init__(self, window=512):
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.window = window
+    self.histograms = {stage: [0] * (len(self.buckets) + 1) for stage in self.stages}
+    self.sums = {stage: 0.0 for stage in self.stages}
+    self.recent = {stage: deque(maxlen=self.window) for stage in self.stages}
+    self.images = {}      # output_ext: images written
+    self.bytes = {}       # output_ext: bytes written
+  
+  def observe(self, stage, seconds):
+    with self.lock:
+      histogram = self.histograms.setdefault(stage, [0] * (len(self.buckets) + 1))
+      index = next((i for i, bound in enumerate(self.buckets) if seconds <= bound), len(self.buckets))
+      histogram[index] += 1
+      self.sums[stage] = self.sums.get(stage, 0.0) + seconds
+      self.recent.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+  
+  def record(self, timer):
+    for stage, seconds in timer.stages.items():
+      self.observe(stage, seconds)
+    self.observe('total', timer.elapsed())
+  
+  def wrote(self, output_ext, size, seconds=None):
+    if seconds is not None: self.observe('encode', seconds)
+    with self.lock:
+      self.images[output_ext] = self.images.get(output_ext, 0) + 1
+      self.bytes[output_ext] = self.bytes.get(output_ext, 0) + size
+  
+  def snapshot(self):
+    with self.lock:
+      stages = {}
+      for stage, histogram in self.histograms.items():
+        count = sum(histogram)
+        if not count: continue
+        recent = sorted(self.recent[stage])
+        stages[stage] = {
+          'count': count,
+          'sum': self.sums[stage],
+          'p50': recent[len(recent) // 2],
+          'p95': recent[min(int(len(recent) * 0.95), len(recent) - 1)],
+          'max': recent[-1],
+        }
+      images = sum(self.images.values())
+      return {
+        'version': version,
+        'uptime': time.time() - self.started,
+        'stages': stages,
+        'images': dict(self.images),
+        'bytes': dict(self.bytes),
+        'images_per_second': images / self.sums['total'] if self.sums['total'] else 0.0,
+      }
+  
+  # Prometheus text exposition format 0.0.4
+  def prometheus(self):
+    lines = [
+      '# HELP save_image_extended_stage_seconds Time spent in each stage of SaveImageExtended.save_images',
+      '# TYPE save_image_extended_stage_seconds histogram',
+    ]
+    with self.lock:
+      for stage, histogram in self.histograms.items():
+        cumulative = 0
+        for bound, count in zip(self.buckets + ['+Inf'], histogram):
+          cumulative += count
+          lines.append(f'save_image_extended_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+        lines.append(f'save_image_extended_stage_seconds_sum{{stage="{stage}"}} {self.sums[stage]}')
+        lines.append(f'save_image_extended_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+      lines.append('# HELP save_image_extended_images_total Images written, per output_ext')
+      lines.append('# TYPE save_image_extended_images_total counter')
+      lines += [f'save_image_extended_images_total{{ext="{ext}"}} {count}' for ext, count in self.images.items()]
+      lines.append('# HELP save_image_extended_bytes_total Bytes of images written, per output_ext')
+      lines.append('# TYPE save_image_extended_bytes_total counter')
+      lines += [f'save_image_extended_bytes_total{{ext="{ext}"}} {size}' for ext, size in self.bytes.items()]
+    return '\n'.join(lines) + '\n'
+
+save_metrics = SaveMetrics()
+
+# class EncodeBudget ------------------------------------------------------------------------------------
+# encode_budget_ms: recent encode times of each (output_ext, encode_speed), in seconds per megapixel.
+# choose() starts from the fastest preset and climbs one step at a time, only while the weaker preset left half the budget free.
+class EncodeBudget:
+  def __init__(self, window=16):
+    self.lock = threading.Lock()
+    self.window = window
+    self.recent = {}      # (output_ext, encode_speed): deque of seconds per megapixel
+  
+  def observe(self, output_ext, encode_speed, seconds, pixels):
+    with self.lock:
+      self.recent.setdefault((output_ext, encode_speed), deque(maxlen=self.window)).append(seconds / max(pixels / 1e6, 1e-6))
+  
+  # expected seconds to encode pixels, None when never measured
+  def estimate(self, output_ext, encode_speed, pixels):
+    with self.lock:
+      recent = self.recent.get((output_ext, encode_speed))
+      if not recent: return None
+      return sum(recent) / len(recent) * pixels / 1e6
+  
+  # encode_speeds from the fastest to the smallest
+  def choose(self, output_ext, encode_speeds, pixels, budget):
+    chosen = encode_speeds[0]
+    for encode_speed in encode_speeds[1:]:
+      previous = self.estimate(output_ext, chosen, pixels)
+      estimate = self.estimate(output_ext, encode_speed, pixels)
+      if estimate is None:
+        # never tried: worth a try when the weaker preset is well within the budget
+        if previous is not None and previous * 2 <= budget: chosen = encode_speed
+        break
+      if estimate > budget: break
+      chosen = encode_speed
+    return chosen
+
+encode_budget = EncodeBudget()
+
+# stages of one save_images call: lap(stage) adds the time since the previous lap to that stage
+class StageTimer:
+  def __init__(self):
+    self.start = self.last = time.perf_counter()
+    self.stages = {}
+  
+  def lap(self, stage):
+    now = time.perf_counter()
+    self.stages[stage] = self.stages.get(stage, 0.0) + now - self.last
+    self.last = now
+  
+  def elapsed(self):
+    return self.last - self.start
+
+
+# class AsyncImageWriter --------------------------------------------------------------------------------
+# Bounded background writer used when SaveImageExtended.async_write = True.
+# save_images hands over the converted images and returns right away; Pillow encoders release the GIL, so threads are enough.
+# When queue_depth writes are in flight, submit() blocks: that is the backpressure when the disk or the encoder falls behind.
+class AsyncImageWriter:
+  def __init__(self, max_workers=2, queue_depth=8):
+    self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='save_image_extended')
+    self.slots = threading.BoundedSemaphore(max(queue_depth, 1))
+    self.lock = threading.Lock()
+    # notified when write_done is over: future.result() returns before the done callbacks run
+    self.idle = threading.Condition(self.lock)
+    self.pending = {}     # future: image_path, until write_done is over
+    self.errors = []      # [(image_path, exception)] failed writes, kept until flush()
+    self.waited = set()   # futures the caller waits for: it gets their failure, not flush()
+    self.labels = {}      # future: what failed, for writes that are not image files (archive shards)
+  
+  # stream_frames: same backpressure, but save_images waits for these writes and raises their failure
+  def submit_waited(self, image_path, fn, *args, **kwargs):
+    return self.submit(image_path, fn, *args, waited=True, **kwargs)
+  
+  # label names the write in errors when image_path is empty
+  def submit(self, image_path, fn, *args, waited=False, label=None, **kwargs):
+    self.slots.acquire()
+    try:
+      future = self.executor.submit(fn, *args, **kwargs)
+    except Exception:
+      self.slots.release()
+      raise
+    with self.lock:
+      self.pending[future] = [str(path) for path in image_path] if isinstance(image_path, (list, tuple)) else [str(image_path)]
+      if waited: self.waited.add(future)
+      if label is not None: self.labels[future] = label
+    future.add_done_callback(self.write_done)
+    return future
+  
+  def write_done(self, future):
+    with self.lock:
+      image_paths = self.pending.get(future, [])
+      waited = future in self.waited
+      self.waited.discard(future)
+      label = self.labels.pop(future, None)
+    try:
+      e = future.exception()
+      if e is None:
+        counter_index.files_written(image_paths)
+      elif not waited:
+        # the node has already returned, all we can do is report it
+        if label is not None or not image_paths:
+          image_path = label or 'an unnamed write'
+        elif len(image_paths) == 1:
+          image_path = image_paths[0]
+        else:
+          image_path = f"{len(image_paths)} images in {os.path.dirname(image_paths[0])}"
+        print(f"SaveImageExtended {version} error: background write failed for {image_path}: {e}")
+        with self.lock:
+          self.errors.append((image_path, e))
+    finally:
+      with self.lock:
+        self.pending.pop(future, None)
+        self.idle.notify_all()
+      self.slots.release()
+  
+  # file names still being written in folder_path, so the counter does not hand them out twice
+  def pending_files(self, folder_path):
+    folder_path = str(folder_path)
+    with self.lock:
+      return [os.path.basename(path) for paths in self.pending.values() for path in paths if os.path.dirname(path) == folder_path]
+  
+  # wait for every queued write and its write_done, return and clear the failures
+  def flush(self, timeout=None):
+    with self.lock:
+      futures = list(self.pending)
+      self.idle.wait_for(lambda: not any(future in self.pending for future in futures), timeout)
+      errors, self.errors = self.errors, []
+    return errors
+  
+  def shutdown(self):
+    errors = self.flush()
+    if errors: print(f"SaveImageExtended {version} error: {len(errors)} background write(s) failed before shutdown")
+    self.executor.shutdown(wait=True)
+
+
+# class CounterIndex ------------------------------------------------------------------------------------
+# In-process cache of the next counter per folder and (filename, output_ext, counter_position, counter_digits).
+# Seeded by one scan of the folder, then updated with the names of the files we write.
+# The folder mtime tells when something outside the node touched the folder: then the folder is scanned again.
+# Filesystems with a coarse mtime (FAT: 2s) may miss an outside change made in the same tick as our own write.
+class CounterIndex:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.folders = {}     # folder: {'mtime': st_mtime_ns, 'counters': {key: next counter}}
+  
+  def get(self, folder_path, key, mtime):
+    with self.lock:
+      folder = self.folders.get(str(folder_path))
+      if folder is None: return None
+      if folder['mtime'] != mtime:
+        # touched from outside: every counter of that folder is stale
+        del self.folders[str(folder_path)]
+        return None
+      return folder['counters'].get(key)
+  
+  def set(self, folder_path, key, mtime, counter):
+    with self.lock:
+      folder = self.folders.setdefault(str(folder_path), {'mtime': mtime, 'counters': {}})
+      if folder['mtime'] != mtime:
+        folder['mtime'], folder['counters'] = mtime, {}
+      folder['counters'][key] = counter
+  
+  # counters handed out by save_images, before the files exist
+  def reserve(self, folder_path, key, counter):
+    with self.lock:
+      folder = self.folders.get(str(folder_path))
+      if folder is not None and key in folder['counters']:
+        folder['counters'][key] = max(folder['counters'][key], counter)
+  
+  # files were written: update every counter of their folder and accept the new folder mtime
+  def files_written(self, paths):
+    by_folder = {}
+    for path in paths:
+      by_folder.setdefault(os.path.dirname(str(path)), []).append(os.path.basename(str(path)))
+    with self.lock:
+      for folder_path, files in by_folder.items():
+        folder = self.folders.get(folder_path)
+        if folder is None: continue
+        for key in folder['counters']:
+          filename, output_ext, counter_position, counter_digits = key
+          counters = [file_counter(file, filename, counter_digits, counter_position, output_ext) for file in files]
+          counters = [found for found in counters if found is not None]
+          if counters: folder['counters'][key] = max(folder['counters'][key], max(counters) + 1)
+        try:
+          folder['mtime'] = os.stat(folder_path).st_mtime_ns
+        except OSError:
+          del self.folders[folder_path]
+
+counter_index = CounterIndex()
+
+
+# counter reservation -----------------------------------------------------------------------------------
+# Used when SaveImageExtended.reserve_counters = True, for several ComfyUI instances saving in the same folder.
+# Each call reserves len(images) counters at once in a small counter file of the folder, under an exclusive lock:
+# two workers can never pick the same counter. The folder still has the last word: files written without reservation
+# (reserve_counters off at the time, another tool) are never handed out again. seed() comes from counter_index, so it is cheap.
+# fcntl locks also work on NFS (lockd/NFSv4). Every instance writing in that folder must use reserve_counters.
+counter_file_name = '.save_image_extended.counters.json'
+# archive_format numbering when reserve_counters is off: images in shards are not in the folder to be counted,
+# and the counter file of loose images is left alone
+archive_counter_file_name = '.save_image_extended.archives.json'
+
+def lock_file(f):
+  if fcntl is not None:
+    fcntl.lockf(f, fcntl.LOCK_EX)
+  else:
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+
+def unlock_file(f):
+  if fcntl is not None:
+    fcntl.lockf(f, fcntl.LOCK_UN)
+  else:
+    f.seek(0)
+    msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# returns the first of count counters reserved for key in folder_path: the highest of the counter file and seed(), the next free in the folder
+def reserve_counters(folder_path, key, count, seed, file_name=counter_file_name):
+  counter_path = os.path.join(folder_path, file_name)
+  name = '|'.join(str(item) for item in key)
+  fd = os.open(counter_path, os.O_RDWR | os.O_CREAT, 0o666)
+  with os.fdopen(fd, 'r+') as f:
+    lock_file(f)
+    try:
+      f.seek(0)
+      content = f.read()
+      try:
+        counters = json.loads(content) if content else {}
+      except json.JSONDecodeError:
+        print(f"SaveImageExtended {version} error: The file {counter_path} is malformed. Counters will be found again from the files.")
+        counters = {}
+      counter = max(counters.get(name) or 0, seed())
+      counters[name] = counter + count
+      f.seek(0)
+      f.truncate()
+      f.write(json.dumps(counters))
+      # must reach the file before the lock is released
+      f.flush()
+    finally:
+      unlock_file(f)
+  if debug: print(f"debug reserve_counters: {name} counters {counter} to {counter + count - 1}")
+  return counter
+
+
+# class ArchiveShards -----------------------------------------------------------------------------------
+# archive_format = 'tar' or 'zip': images and their job data are appended to rolling shards of the folder, one file instead of thousands.
+# A shard is closed and the next one opened past archive_shard_bytes or archive_shard_count images. Each process opens its own shards,
+# numbered through reserve_counters, so several instances can share a folder. Members follow the WebDataset layout:
+# an image and its json share the same name. tar members are readable as soon as written; a zip is complete once closed,
+# when it rolls over or when ComfyUI exits.
+class ArchiveShards:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.shards = {}      # (folder, archive_format): {'archive', 'path', 'count', 'bytes'}
+  
+  def open_shard(self, folder_path, archive_format, shard_name, counter_file):
+    key = (shard_name, f'.{archive_format}', 'last', 6)
+    # first shard of that folder: next to the ones already there
+    seed = lambda: max([file_counter(file, shard_name, 6, 'last', f'.{archive_format}') or 0 for file in os.listdir(folder_path)], default=0) + 1
+    number = reserve_counters(folder_path, key, 1, seed, counter_file)
+    path = os.path.join(folder_path, f'{shard_name}-{number:06}.{archive_format}')
+    if archive_format == 'tar':
+      archive = tarfile.open(path, 'x', format=tarfile.PAX_FORMAT)
+    else:
+      # images are compressed already
+      archive = zipfile.ZipFile(path, 'x', compression=zipfile.ZIP_STORED)
+    if debug: print(f"debug ArchiveShards: opened {path}")
+    return {'archive': archive, 'path': path, 'count': 0, 'bytes': 0}
+  
+  # members: [(name, bytes)] of one image. Returns the shard path. counter_file numbers the shards, see reserve_counters
+  def add(self, folder_path, archive_format, members, shard_name, max_bytes, max_count, counter_file=counter_file_name):
+    with self.lock:
+      key = (str(folder_path), archive_format)
+      shard = self.shards.get(key)
+      if shard is not None and (shard['count'] >= max_count or shard['bytes'] >= max_bytes):
+        shard['archive'].close()
+        shard = None
+      if shard is None:
+        shard = self.shards[key] = self.open_shard(folder_path, archive_format, shard_name, counter_file)
+      archive = shard['archive']
+      for name, data in members:
+        if archive_format == 'tar':
+          info = tarfile.TarInfo(name)
+          info.size = len(data)
+          info.mtime = time.time()
+          archive.addfile(info, io.BytesIO(data))
+        else:
+          archive.writestr(zipfile.ZipInfo(name, datetime.now().timetuple()[:6]), data)
+        shard['bytes'] += len(data)
+      if archive_format == 'tar': archive.fileobj.flush()
+      shard['count'] += 1
+      return shard['path']
+  
+  def close(self):
+    with self.lock:
+      for shard in self.shards.values():
+        shard['archive'].close()
+      self.shards = {}
+
+archive_shards = ArchiveShards()
+
+@atexit.register
+def close_archive_shards():
+  archive_shards.close()
+
+
+# class DedupIndex --------------------------------------------------------------------------------------
+# SaveImageExtended.dedup: hash of the pixels and of the encoder options, metadata included -> image already written with them.
+# Kept per output root in .save_image_extended.hashes.jsonl, one {"hash", "path"} line appended with a single write:
+# several instances can share it, the lines they add are read when the file grows.
+dedup_index_name = '.save_image_extended.hashes.jsonl'
+
+def dedup_digest(frame, encoder_digest):
+  digest = hashlib.blake2b(numpy.ascontiguousarray(frame), digest_size=20)
+  digest.update(str(frame.shape).encode('ascii'))
+  digest.update(encoder_digest)
+  return digest.hexdigest()
+
+class DedupIndex:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.roots = {}       # output root: {'offset': bytes read, 'hashes': {hash: path relative to root}}
+  
+  # read the lines added since last time, by us or other instances
+  def refresh(self, root):
+    index = self.roots.setdefault(root, {'offset': 0, 'hashes': {}})
+    index_path = os.path.join(root, dedup_index_name)
+    try:
+      if os.path.getsize(index_path) <= index['offset']: return index
+      with open(index_path, 'rb') as f:
+        f.seek(index['offset'])
+        data = f.read()
+    except FileNotFoundError:
+      return index
+    # a line still being written by someone else is read next time
+    data = data[:data.rfind(b'\n') + 1]
+    index['offset'] += len(data)
+    for line in data.splitlines():
+      try:
+        entry = json.loads(line)
+        index['hashes'][entry['hash']] = entry['path']
+      except (json.JSONDecodeError, KeyError, TypeError):
+        pass
+    return index
+  
+  # path of the image written with that hash, None when unknown or gone
+  def find(self, root, digest):
+    with self.lock:
+      index = self.refresh(root)
+      relative_path = index['hashes'].get(digest)
+      if relative_path is None: return None
+      path = os.path.join(root, relative_path)
+      if os.path.isfile(path): return path
+      del index['hashes'][digest]
+      return None
+  
+  def add(self, root, digest, path):
+    relative_path = os.path.relpath(path, root)
+    line = json.dumps({'hash': digest, 'path': relative_path}) + '\n'
+    with self.lock:
+      fd = os.open(os.path.join(root, dedup_index_name), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+      try:
+        os.write(fd, line.encode('utf-8'))
+      finally:
+        os.close(fd)
+      self.roots.setdefault(root, {'offset': 0, 'hashes': {}})['hashes'][digest] = relative_path
+
+dedup_index = DedupIndex()
+
+
+# class FolderShards ------------------------------------------------------------------------------------
+# SaveImageExtended.folder_shard_files: once a folder holds that many entries, new saves go into numbered subfolders of it,
+# 0001, 0002..., each filled up to the same size. Listing, the file pickers, rsync and backups stay fast whatever the job count.
+# Counters continue across shards: a new shard starts after the last counter of the previous one.
+# Each folder is scanned once per process, then counted from our own saves: with several instances a shard may end a bit larger.
+class FolderShards:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.folders = {}   # folder: {'shard': current shard number, 0 = the folder itself, 'files': entries in it}
+  
+  def scan(self, folder_path, digits):
+    try:
+      shards = [int(entry.name) for entry in os.scandir(folder_path) if len(entry.name) == digits and entry.name.isdecimal() and entry.is_dir()]
+    except FileNotFoundError:
+      return {'shard': 0, 'files': 0}
+    shard = max(shards, default=0)
+    return {'shard': shard, 'files': sum(1 for entry in os.scandir(shard_path(folder_path, shard, digits)) if not entry.name.startswith('.'))}
+  
+  # reserves room for count new files: returns (shard path, previous shard path or None)
+  def place(self, folder_path, count, max_files, digits):
+    with self.lock:
+      folder = self.folders.get(str(folder_path))
+      if folder is None: folder = self.folders[str(folder_path)] = self.scan(folder_path, digits)
+      if folder['files'] > 0 and folder['files'] + count > max_files:
+        folder['shard'] += 1
+        folder['files'] = 0
+      folder['files'] += count
+      shard = folder['shard']
+    return shard_path(folder_path, shard, digits), (shard_path(folder_path, shard - 1, digits) if shard > 0 else None)
+
+def shard_path(folder_path, shard, digits):
+  return os.path.join(folder_path, f'{shard:0{digits}d}') if shard > 0 else str(folder_path)
+
+folder_shards = FolderShards()
+
+
+# class OutputCatalog -----------------------------------------------------------------------------------
+# SaveImageExtended.catalog: one SQLite database at the root of the output folder, one row per image saved,
+# with the sampler and model values of its job. Finding every image of a seed or a checkpoint becomes one indexed query
+# instead of parsing every jobs.json. WAL mode: /save_image_extended/catalog reads while the node writes, and several
+# instances can share the database. Rows of one save_images call go in one transaction.
+class OutputCatalog:
+  columns = ['path', 'counter', 'format', 'size', 'width', 'height', 'timestamp',
+    'seed', 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise', 'checkpoint', 'loras', 'vae',
+    'positive_prompt', 'negative_prompt', 'job']
+  schema = '''
+    CREATE TABLE IF NOT EXISTS images (
+      id INTEGER PRIMARY KEY,
+      path TEXT NOT NULL, counter INTEGER, format TEXT, size INTEGER, width INTEGER, height INTEGER, timestamp TEXT,
+      seed INTEGER, steps INTEGER, cfg REAL, sampler_name TEXT, scheduler TEXT, denoise REAL,
+      checkpoint TEXT, loras TEXT, vae TEXT, positive_prompt TEXT, negative_prompt TEXT, job TEXT
+    );
+    CREATE INDEX IF NOT EXISTS images_path ON images (path);
+    CREATE INDEX IF NOT EXISTS images_timestamp ON images (timestamp);
+    CREATE INDEX IF NOT EXISTS images_seed ON images (seed);
+    CREATE INDEX IF NOT EXISTS images_checkpoint ON images (checkpoint);
+    CREATE INDEX IF NOT EXISTS images_sampler ON images (sampler_name, scheduler);
+  '''
+  # query filters: name: (sql, how the value is matched)
+  filters = {
+    'seed': ('seed = ?', int),
+    'steps': ('steps = ?', int),
+    'cfg': ('cfg = ?', float),
+    'sampler_name': ('sampler_name = ?', str),
+    'scheduler': ('scheduler = ?', str),
+    'checkpoint': ('checkpoint = ?', str),
+    'format': ('format = ?', str),
+    'lora': ("loras LIKE ? ESCAPE '\\'", lambda value: f'%{like_escape(value)}%'),
+    'prompt': ("positive_prompt LIKE ? ESCAPE '\\'", lambda value: f'%{like_escape(value)}%'),
+    'subfolder': ("path LIKE ? ESCAPE '\\'", lambda value: f'{like_escape(value.strip("/"))}/%'),
+    'since': ('timestamp >= ?', str),
+    'until': ('timestamp < ?', str),
+  }
+  
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.connections = {}   # database path: sqlite3 connection
+  
+  def connect(self, db_path):
+    connection = self.connections.get(db_path)
+    if connection is None:
+      connection = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+      connection.execute('PRAGMA journal_mode=WAL')
+      connection.execute('PRAGMA synchronous=NORMAL')
+      connection.executescript(self.schema)
+      self.connections[db_path] = connection
+    return connection
+  
+  # rows: [{column: value}]
+  def insert(self, db_path, rows):
+    with self.lock:
+      connection = self.connect(db_path)
+      with connection:
+        connection.executemany(f"INSERT INTO images ({', '.join(self.columns)}) VALUES ({', '.join('?' * len(self.columns))})",
+          [tuple(row.get(column) for column in self.columns) for row in rows])
+  
+  # newest first. query: {filter name: value}, see filters. Raises ValueError on a bad value
+  def query(self, db_path, query, limit=100, offset=0):
+    where = []
+    values = []
+    for name, value in query.items():
+      if name in self.filters:
+        sql, convert = self.filters[name]
+        where.append(sql)
+        values.append(convert(value))
+    sql = f"SELECT {', '.join(self.columns)} FROM images"
+    if where: sql += ' WHERE ' + ' AND '.join(where)
+    sql += ' ORDER BY id DESC LIMIT ? OFFSET ?'
+    with self.lock:
+      connection = self.connect(db_path)
+      rows = connection.execute(sql, values + [int(limit), int(offset)]).fetchall()
+    return [dict(zip(self.columns, row)) for row in rows]
+  
+  def close(self):
+    with self.lock:
+      for connection in self.connections.values():
+        connection.close()
+      self.connections = {}
+
+def like_escape(value):
+  return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+output_catalog = OutputCatalog()
+
+@atexit.register
+def close_output_catalog():
+  output_catalog.close()
+
+
+async_writer = None
+async_writer_lock = threading.Lock()
+
+def get_async_writer(max_workers, queue_depth):
+  global async_writer
+  with async_writer_lock:
+    if async_writer is None:
+      async_writer = AsyncImageWriter(max_workers, queue_depth)
+    return async_writer
+
+@atexit.register
+def flush_async_writer():
+  if async_writer is not None:
+    async_writer.shutdown()
+
+
+# class PromptIndex -------------------------------------------------------------------------------------
+# The prompt walked once per save: widget name -> [(node_id, value)], in the order the prompt is walked, the last one wins.
+# ckpt/control_net/lora widgets also get their derived _name and _path entries for the filename/foldername keys.
+# Both generate_custom_name and save_job_to_json resolve their keys against it.
+class PromptIndex:
+  # widget: (name key, path key)
+  model_keys = {
+    'ckpt_name': ('ckpt_name', 'ckpt_path'), 'ckpt_path': ('ckpt_name', 'ckpt_path'),
+    'control_net_name': ('control_net_name', 'control_net_path'), 'control_net_path': ('control_net_name', 'control_net_path'),
+    'lora_name': ('lora_name', 'lora_path'), 'lora_path': ('lora_name', 'lora_path'),
+  }
+  # Match both formats: lora_xx and lora_name_x
+  lora_key = re.compile(r'lora(_name)?(_\d+)?')
+  
+  def __init__(self, prompt, cleanup):
+    self.cleanup = cleanup
+    self.values = {}    # widget: [(node_id, value)] as found, for job data
+    self.names = {}     # ckpt/control_net/lora _name and _path: [(node_id, value)] for filename/foldername keys
+    self.loras = []
+    if prompt:
+      self.walk(prompt, None)
+  
+  def walk(self, prompt, node_id):
+    for key, value in prompt.items():
+      # top level keys are the node ids
+      owner = key if node_id is None else node_id
+      if isinstance(value, dict):
+        self.walk(value, owner)
+        # pythongosssss/ComfyUI-Custom-Scripts stores the value as a dict: value={'content': 'v1-5-pruned-emaonly.safetensors', 'image': 'checkpoints/v1-5-pruned-emaonly.jpg'}
+        value = value.get('content', '')
+      
+      if value is not None and self.lora_key.match(key):
+        self.loras.append(self.cleanup(value))
+      self.values.setdefault(key, []).append((owner, self.cleanup(value)))
+      
+      if key in self.model_keys and isinstance(value, str):
+        name_key, path_key = self.model_keys[key]
+        value_path = Path(value)
+        self.names.setdefault(name_key, []).append((owner, self.cleanup(str(value_path.name))))
+        self.names.setdefault(path_key, []).append((owner, self.cleanup(str(value_path.parent))))
+  
+  # (found, value) of key for filename/foldername, optionally only in node_id
+  def find(self, key, node_id=None):
+    entries = self.names.get(key, []) if key in self.model_keys else self.values.get(key, [])
+    for owner, value in reversed(entries):
+      if node_id is None or owner == node_id:
+        return True, value
+    return False, None
+  
+  # {key: value} of the keys found, for job data. 'loras' is every lora found, comma separated
+  def parameters(self, keys):
+    found_values = {key: entries[-1][1] for key, entries in self.values.items() if key in keys}
+    if 'loras' in keys and self.loras:
+      found_values['loras'] = ', '.join(str(lora) for lora in self.loras)
+    return found_values
+
+
+# job log -----------------------------------------------------------------------------------------------
+# Legacy jobs.json content from a jobs.jsonl job log: {strftime('%c'): job}. Written to json_path when given.
+# Jobs saved within the same second used to overwrite each other in jobs.json, they now get a " (2)" suffix.
+def export_job_log(jsonl_path, json_path=None):
+  jobs = {}
+  set_time_locale()
+  with open(jsonl_path, 'r', encoding='utf-8') as f:
+    for number, line in enumerate(f, 1):
+      if not line.strip(): continue
+      try:
+        entry = json.loads(line)
+        key = datetime.fromisoformat(entry['timestamp']).strftime('%c')
+      except (json.JSONDecodeError, KeyError, TypeError, ValueError):
+        # only a crash during the write can do that, and only to the last line
+        print(f"SaveImageExtended {version} error: {jsonl_path} line {number} is malformed, skipped.")
+        continue
+      unique_key, duplicate = key, 1
+      while unique_key in jobs:
+        duplicate += 1
+        unique_key = f"{key} ({duplicate})"
+      jobs[unique_key] = entry.get('job', {})
+  
+  if json_path is not None:
+    write_file_atomic(json_path, json.dumps(jobs, indent=4).encode('utf-8'))
+  return jobs
+
+
+# metadata ----------------------------------------------------------------------------------------------
+# marks a compressed prompt/workflow in EXIF, see genMetadataEXIFText
+metadata_compressed_marker = 'zlib+base64:'
+
+# reverse of genMetadataEXIFText, for the text following "Prompt: " or "Workflow: "
+def decode_metadata_text(text):
+  if text.startswith(metadata_compressed_marker):
+    return zlib.decompress(base64.b64decode(text[len(metadata_compressed_marker):])).decode('utf-8')
+  return text
+
+
+# class PreviewCache ------------------------------------------------------------------------------------
+# preview_only input: encoded images live here instead of on disk, until they are persisted or pushed out by newer ones.
+# Bounded by the total size of the entries, least recently used first out.
+class PreviewCache:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.entries = OrderedDict()
+    self.size = 0
+  
+  def entry_size(self, entry):
+    return len(entry['data']) + (len(entry['display']) if entry['display'] is not entry['data'] else 0)
+  
+  def put(self, entry, max_bytes):
+    key = uuid.uuid4().hex
+    with self.lock:
+      self.entries[key] = entry
+      self.size += self.entry_size(entry)
+      # the newest one stays, even when it is bigger than max_bytes on its own
+      while self.size > max_bytes and len(self.entries) > 1:
+        _, dropped = self.entries.popitem(last=False)
+        self.size -= self.entry_size(dropped)
+    return key
+  
+  def get(self, key):
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is not None: self.entries.move_to_end(key)
+      return entry
+  
+  def pop(self, key):
+    with self.lock:
+      entry = self.entries.pop(key, None)
+      if entry is not None: self.size -= self.entry_size(entry)
+      return entry
+
+preview_cache = PreviewCache()
+
+
+# class NameTemplate ------------------------------------------------------------------------------------
+# filename_keys/foldername_keys compiled once into a list of tokens, see compile_name_template.
+# Each save only renders the tokens against the prompt index and the timestamp.
+#   ('folder', '../')          subfolder separator in front of a key
+#   ('datetime', '%F')         datetime format
+#   ('fixed', 'string')        fixed string: quoted, string.string, .string, string.
+#   ('resolution', None)       that's a secret keyword
+#   ('key', (node, widget))    widget value, from node #node when node is not None
+class NameTemplate:
+  subfolder_split = re.compile('/+')
+  whitespaces = re.compile(r'\s+')
+  illegal_characters = re.compile(r'[*?:"<>|]')
+  model_path_keys = ['ckpt_path', 'control_net_path', 'lora_path']
+  
+  def __init__(self, keys, delimiter, named_keys):
+    self.delimiter = delimiter
+    self.named_keys = named_keys
+    self.tokens = []
+    # keys == [''] means no keys at all
+    if keys != ['']:
+      for key in keys: self.compile_key(key)
+  
+  def compile_key(self, key):
+    # empty comma
+    if not key: return
+    kind = None
+    
+    # datetime format
+    if '%' in key:
+      kind, value = 'datetime', key
+    
+    # check if there is an os.sep involved, cleanup the key
+    if '/' in key:
+      # key is a subfolder: ./key or ../key or /key ==> last / is removed
+      values = self.subfolder_split.split(key)
+      # we will strip the last / in all cases
+      if values[0] in ['','.','..']:
+        self.tokens.append(('folder', values[0]+'/'))
+        key = values[1]
+        # was it just a folder separator?
+        if not key: return
+      else:
+        key = values[0]
+    
+    # fixed string:
+    if (key.startswith("'") and key.endswith("'")) or (key.startswith('"') and key.endswith('"')):
+      kind, value = 'fixed', key
+    
+    # is it num.key ?
+    if kind is None:
+      splitKey = key.split('.')
+      # we also exclude cases like "..string" or "sting.string.x" etc
+      if len(splitKey) == 2:
+        if '' not in splitKey and splitKey[0].isdecimal():
+          # key has the form num.widget_name like 123.widget_name, we will then look for widget_name value in node #123
+          kind, value = 'key', (splitKey[0], splitKey[1])
+        else:
+          # key is in the form string.string = fixed string; still, we remove extra stuff and known extensions
+          # or in the form ".string" or "string." or "." - maybe it's a separator
+          kind, value = 'fixed', key
+      elif key == 'resolution':
+        kind, value = 'resolution', None
+      else:
+        # key is not a datetime, folder, has no dot, or multiple dots, could be a valid key to find, could be a fixed string - keep as is
+        kind, value = 'key', (None, key)
+    
+    self.tokens.append((kind, value))
+  
+  def render(self, prefix, prompt, prompt_index, resolution, timestamp, cleanup):
+    set_time_locale()
+    custom_name = []
+    
+    # only filename has prefix
+    if prefix:
+      if '%' in prefix:
+        custom_name.append(timestamp.strftime(prefix))
+      else:
+        custom_name.append(prefix)
+    
+    if prompt is not None:
+      # now separating numbered keys from non-numbered keys:
+      #   37.ckpt_name = i want the ckpt_name from node #37
+      #      ckpt_name = i want the ckpt_name from the highest numbered node = the last one found
+      found_values = {}
+      for kind, value in self.tokens:
+        nodeKey = None
+        if kind == 'folder':
+          custom_name.append(value)
+          continue
+        elif kind == 'datetime':
+          value = timestamp.strftime(value)
+        elif kind == 'resolution':
+          value = resolution
+        elif kind == 'key':
+          node, nodeKey = value
+          if node is None:
+            found, found_value = prompt_index.find(nodeKey)
+          elif node in prompt:
+            # node number found in prompt, we will look only in that node:
+            found, found_value = prompt_index.find(nodeKey, node)
+          else:
+            # #num node not found in prompt; #num could have changed or user made a typo. Fallback to normal key search
+            print(f"SaveImageExtended info: node #{node} not found")
+            found, found_value = prompt_index.find(nodeKey)
+          if found: found_values[nodeKey] = found_value
+          
+          value = None
+          if nodeKey in found_values:
+            if self.named_keys:
+              value = f"{nodeKey}={found_values[nodeKey]}"
+            else:
+              value = found_values[nodeKey]
+          # unknown keys are fixed strings
+          if value is None: value = nodeKey
+        
+        if debug: print(f"debug generate_custom_name: ----{kind} {nodeKey}: {value}")
+        if isinstance(value, str):
+          # PromptIndex creates ckpt_path and ckpt_name already; we just need to eliminate path if == '.'
+          if nodeKey in self.model_path_keys:
+            # no such model in the prompt: the key is a fixed string, like any unknown key
+            value = found_values.get(nodeKey, value)
+          else:
+            value = cleanup(value)
+        elif isinstance(value, float):
+          # value = round(float(value), 1)  # too much rounding
+          value = float(f'{value:.10g}')
+        
+        custom_name.append(str(value))
+    
+    delimiter = self.delimiter
+    # remove empty values, strip each item
+    custom_name = [item.strip() for item in custom_name if item]
+    # join
+    stringName = delimiter.join(custom_name).replace('/'+delimiter, '/').replace(delimiter+'/', '/').replace(delimiter+'.', '.')
+    # clean and remove line feeds
+    stringName = self.whitespaces.sub(' ', stringName).strip(delimiter).strip('/').strip(delimiter).strip('.')
+    
+    if debug: print(f"debug generate_custom_name: ------custom_name: {custom_name}")
+    if debug: print(f"debug generate_custom_name: ------stringName:  {stringName}")
+    return self.illegal_characters.sub('', stringName).replace('/', os.sep)
+
+
+# the same filename_keys/foldername_keys come back on every save
+@lru_cache(maxsize=128)
+def compile_name_template(keys_string, delimiter, named_keys):
+  return NameTemplate([item.strip() for item in keys_string.split(',')], delimiter, named_keys)
 
 
 # class SaveImageExtended -------------------------------------------------------------------------------
@@ -122,6 +1332,78 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   # quality is a lossy compression unused by PNG/tiff/gif but also translated to integers 0-9 for PNG compression level
   quality                 = 90
   named_keys              = False
+  # encode_speed: encoder effort per format, 'default' keeps the plugin defaults. Presets go from the fastest to the smallest file
+  encode_speed            = 'default'
+  encode_speeds           = ['default', 'fastest', 'balanced', 'smallest']
+  encode_presets          = {
+    '.webp': {'fastest': {'method': 0}, 'balanced': {'method': 4}, 'smallest': {'method': 6}},
+    '.avif': {'fastest': {'speed': 10}, 'balanced': {'speed': 6}, 'smallest': {'speed': 2}},
+    '.jxl':  {'fastest': {'effort': 1}, 'balanced': {'effort': 7}, 'smallest': {'effort': 9}},
+    '.jpg':  {'fastest': {'optimize': False}, 'balanced': {'optimize': True}, 'smallest': {'optimize': True, 'progressive': True}},
+    '.jpeg': {'fastest': {'optimize': False}, 'balanced': {'optimize': True}, 'smallest': {'optimize': True, 'progressive': True}},
+    '.png':  {'fastest': {'compress_level': 1}, 'balanced': {'compress_level': 4}, 'smallest': {'compress_level': 9}},
+  }
+  # batch_as_sequence: the batch is saved as one animated or multi-page file, in those formats only
+  batch_as_sequence       = False
+  sequence_exts           = ['.webp', '.avif', '.gif', '.png', '.tiff']
+  frame_duration          = 100
+  # catalog: every saved image is also recorded in catalog_name at the root of the output folder, see /save_image_extended/catalog
+  catalog                 = False
+  catalog_name            = 'save_image_extended.sqlite'
+  # folder_shard_files: past this many entries, a folder gets numbered subfolders of folder_shard_digits digits, filled in turn. 0 = off
+  folder_shard_files      = 0
+  folder_shard_digits     = 4
+  # durability: files are always written to a temp file, then renamed. 'fsync' flushes each file to disk before its rename,
+  # 'fsync+dir' also flushes their folders once per save_images call, for the new names to survive a power loss
+  durability              = 'none'
+  durabilities            = ['none', 'fsync', 'fsync+dir']
+  # dedup: identical pixels + metadata already saved under the output folder are not encoded again.
+  # 'hardlink' / 'symlink' the new name to the existing file, 'reference' writes nothing and shows the existing image
+  dedup                   = 'disabled'
+  dedup_modes             = ['disabled', 'hardlink', 'symlink', 'reference']
+  # extra_formats: the same images also saved in these formats, same name and counter: '.avif:80, .png'
+  extra_formats           = ''
+  # archive_format: images and job data go in rolling tar/zip shards of the folder, named {archive_shard_name}-000001.tar
+  archive_format          = 'disabled'
+  archive_formats         = ['disabled', 'tar', 'zip']
+  archive_shard_name      = 'shard'
+  archive_shard_bytes     = 1024 * 1024 * 1024
+  archive_shard_count     = 10000
+  # encode_budget_ms: milliseconds per image; the strongest preset that met it on recent saves is used instead of encode_speed. 0 = off
+  encode_budget_ms        = 0
+  # large_image_pixels: frames of at least that many pixels are converted and encoded in strips of large_image_tile rows:
+  # PNG streamed, TIFF tiled (with tifffile), JPEG2000 tiled with resolution levels. 0 = off
+  large_image_pixels      = 0
+  large_image_tile        = 1024
+  # stream_frames: batches of at least that many images are converted frame by frame, stream_depth frames ahead of the encoder,
+  # and encoded by the async_workers threads while the next frames are converted. 0 = off
+  stream_frames           = 0
+  stream_depth            = 4
+  # async_write: hand the encodes to a background thread pool and return before the files are written.
+  # async_queue_depth is how many images can be in flight before save_images waits for the disk/encoder to catch up.
+  async_write             = False
+  async_workers           = 2
+  async_queue_depth       = 8
+  # parallel_encode: encode the images of a batch on several cores, through a process pool created once. 0 workers = all cores.
+  # The workers are forked from a process with threads running: nothing in them may wait on a lock of the parent, see get_encode_pool
+  parallel_encode         = False
+  parallel_workers        = 0
+  # reserve_counters: several ComfyUI instances save in the same folders. Counters are reserved per batch in a locked counter file
+  reserve_counters        = False
+  # job_log_format: 'json' rewrites jobs.json on every save; 'jsonl' appends one line to jobs.jsonl, see export_job_log for the legacy jobs.json
+  job_log_format          = 'json'
+  # metadata_compress_threshold: prompt/workflow longer than that many characters are embedded compressed. 0 = never
+  metadata_compress_threshold = 0
+  # preview_proxy: the UI gets a small WebP of each image instead of the full size output. Outputs are untouched
+  preview_proxy           = False
+  preview_proxy_size      = 512
+  preview_proxy_quality   = 80
+  # what browsers can display; other formats always get a preview proxy when preview_proxy is on
+  browser_exts            = ['.webp', '.png', '.jpg', '.jpeg', '.gif', '.avif', '.bmp']
+  # preview_only input: size of the in-memory cache of encoded images; the oldest are dropped first
+  preview_cache_bytes     = 512 * 1024 * 1024
+  # print the time of each stage after every save, /save_image_extended/metrics has them anyway
+  metrics_log             = False
 
   print(f"\033[92m[💾 save_image_extended]\033[0m version: {version}\033[0m")
   if jxl_supported:
@@ -196,6 +1478,25 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       'optional': {
         'positive_text_opt': ('STRING', {'forceInput': True, 'tooltip': "Optional string saved as `positive_text_opt` in job.json when `save_job_data`=True"}),
         'negative_text_opt': ('STRING', {'forceInput': True, 'tooltip': "Optional string saved as `negative_text_opt` in job.json when `save_job_data`=True"}),
+        'preview_only': ('BOOLEAN', {'default': False, 'tooltip': "Keep the images in memory and only show them: nothing is written. Right click the node > Save previews to disk to keep them"}),
+        'encode_speed': (self.encode_speeds, {'default': self.encode_speed, 'tooltip': "Encoder effort: WebP method, AVIF speed, JXL effort, JPEG optimize/progressive, PNG compression level. \n* default: the plugins defaults \n* fastest: biggest files \n* smallest: slowest encode"}),
+        'encode_budget_ms': ('INT', {
+          "default": self.encode_budget_ms,
+          "min": 0,
+          "max": 60000,
+          "step": 10,
+          'tooltip': "Time budget per image in milliseconds: uses the strongest encode_speed that met it on recent saves, starting from fastest. 0 = off, encode_speed is used"
+        }),
+        'batch_as_sequence': ('BOOLEAN', {'default': self.batch_as_sequence, 'tooltip': "Save the whole batch as one animated WebP/AVIF/GIF/PNG or multi-page TIFF, with one counter and one metadata. Other formats save one file per image"}),
+        'frame_duration': ('INT', {
+          "default": self.frame_duration,
+          "min": 1,
+          "max": 60000,
+          "step": 1,
+          'tooltip': "Duration of each frame in milliseconds, when batch_as_sequence is on. 100 = 10 fps"
+        }),
+        'archive_format': (self.archive_formats, {'default': self.archive_format, 'tooltip': "Append the images and their job data to rolling tar/zip shards of the folder instead of one file each. For datasets: millions of images in a few files"}),
+        'extra_formats': ('STRING', {'default': self.extra_formats, 'multiline': False, 'tooltip': "Also save each image in these formats, with the same name and counter, encoded at the same time. Comma separated, each with an optional quality: `.avif:80, .png`"}),
                     },
       'hidden': {'prompt': 'PROMPT', 'extra_pnginfo': 'EXTRA_PNGINFO'},
     }
@@ -238,6 +1539,7 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   #  ██████  ██████   ██████  ██   ████    ██    ███████ ██   ██ 
 
   # Get current counter number from file names
+  # The folder is only listed when counter_index has nothing valid for it: after the first scan, the counter is O(1)
   def get_latest_counter(self, folder_path, filename, counter_digits=counter_digits, counter_position=counter_position, output_ext=output_ext):
     counter = 1
     if not os.path.exists(folder_path):
@@ -245,33 +1547,25 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       return counter
     
     try:
+      mtime = os.stat(folder_path).st_mtime_ns
+      indexed = counter_index.get(folder_path, self.counter_key(filename, counter_digits, counter_position, output_ext), mtime)
+      if indexed is not None:
+        if debug: print(f"debug get_latest_counter: counter={indexed} (indexed)")
+        return indexed
+      
       # grab all files with output_ext
-      files = [file for file in os.listdir(folder_path) if file.endswith(output_ext)]
+      files = os.listdir(folder_path)
+      # async_write: files still in the queue are not on disk yet
+      if async_writer is not None: files += async_writer.pending_files(folder_path)
       # ['0001.webp', '0003-a.webp', 'AnythingV5_inkBase-0001.webp', 'AnythingV5_inkBase-0002.webp']
-
-      extLen = len(output_ext)
-      # '.webp' = 5
-
-      if files:
-        # get default counter position if passed value is somehow not in the allowed values list
-        if counter_position not in self.counter_positions: counter_position = self.counter_position
-        
-        # issue/48 needs a special case for files, counter_position does not matter here, but the filename length does
-        if not filename:
-          counters = [int(file[:counter_digits]) if (file[:counter_digits].isdecimal() and len(file)==(counter_digits+extLen)) else 0 for file in files]
-          # [1, 0, 0, 0]
-        else:
-          if counter_position == 'last':
-            counters = [int(file[-(extLen + counter_digits):-extLen]) if file[-(extLen + counter_digits):-extLen].isdecimal() else 0 for file in files if file.startswith(filename)]
-            # [1, 0, 1, 2]
-          else:
-            # file[:counter_digits] = '0001'
-            # file[counter_digits +1:] = 'webp'
-            counters = [int(file[:counter_digits]) if file[:counter_digits].isdecimal() else 0 for file in files if file[counter_digits +1:].startswith(filename)]
-            # [1, 3, 0, 0]
-        
-        if counters:
-          counter = max(counters) + 1
+      filename, output_ext, counter_position, counter_digits = self.counter_key(filename, counter_digits, counter_position, output_ext)
+      counters = [file_counter(file, filename, counter_digits, counter_position, output_ext) for file in files]
+      counters = [found for found in counters if found is not None]
+      # [1, 0, 1, 2]
+      
+      if counters:
+        counter = max(counters) + 1
+      counter_index.set(folder_path, self.counter_key(filename, counter_digits, counter_position, output_ext), mtime, counter)
     
     except Exception as e:
       print(f"SaveImageExtended {version} error: An error occurred while finding the latest counter: {e}")
@@ -280,43 +1574,11 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
     return counter
   
   
-  # find_keys_recursively is a self-updating recursive method, that will update the dict found_values
-  def find_keys_recursively(self, prompt={}, keys_to_find=[], found_values={}):
-    if debug: print(f"debug find_keys_recursively: keys_to_find={keys_to_find} found_values={found_values}")
-    for key, value in prompt.items():
-      if key in keys_to_find:
-        if debug: print(f"debug find_keys_recursively: found key={key}")
-        if debug: print(f"debug find_keys_recursively: value={value}")
-        # pythongosssss/ComfyUI-Custom-Scripts stores the value as a dict: value={'content': 'v1-5-pruned-emaonly.safetensors', 'image': 'checkpoints/v1-5-pruned-emaonly.jpg'}
-        if isinstance(value, dict):
-          if 'content' in value:
-            value = value['content']
-          else:
-            value = ''
-        
-        if key in ['ckpt_path','ckpt_name']:
-          value_path = Path(value)
-          if 'ckpt_path' in keys_to_find:
-            found_values['ckpt_path'] = self.cleanup_fileName(str(value_path.parent))
-          elif 'ckpt_name' in keys_to_find:
-            found_values['ckpt_name'] = self.cleanup_fileName(str(value_path.name))
-          if debug: print(f"debug find_keys_recursively: ckpt_name={value_path.name} ckpt_path={str(value_path.parent)}")
-        elif key in ['control_net_path','control_net_name']:
-          value_path = Path(value)
-          if 'control_net_path' in keys_to_find:
-            found_values['control_net_path'] = self.cleanup_fileName(str(value_path.parent))
-          elif 'control_net_name' in keys_to_find:
-            found_values['control_net_name'] = self.cleanup_fileName(str(value_path.name))
-        elif key in ['lora_path','lora_name']:
-          value_path = Path(value)
-          if 'lora_path' in keys_to_find:
-            found_values['lora_path'] = self.cleanup_fileName(str(value_path.parent))
-          elif 'lora_name' in keys_to_find:
-            found_values['lora_name'] = self.cleanup_fileName(str(value_path.name))
-        else:
-          found_values[key] = self.cleanup_fileName(value)
-      elif isinstance(value, dict):
-        self.find_keys_recursively(value, keys_to_find, found_values)
+  # key of counter_index
+  def counter_key(self, filename, counter_digits, counter_position, output_ext):
+    # get default counter position if passed value is somehow not in the allowed values list
+    if counter_position not in self.counter_positions: counter_position = self.counter_position
+    return (filename, output_ext, counter_position, counter_digits)
   
   
   def cleanup_fileName(self, file='', extToRemove=modelExtensions):
@@ -328,28 +1590,12 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
     return file
   
   
-  # this method pretty much does the same as find_keys_recursively, except it's for job.json export
-  def find_parameter_values(self, target_keys, prompt={}, found_values={}):
-    loras_string = ''
-    for key, value in prompt.items():
-      if debug: print(f"debug find_parameter_values: key={key} value={value}")
-      if 'loras' in target_keys:
-        # Match both formats: lora_xx and lora_name_x
-        if re.match(r'lora(_name)?(_\d+)?', key):
-          if value is not None:
-            value = self.cleanup_fileName(value)
-            loras_string += f'{value}, '
-      
-      # test if value is dict BEFORE cleaning up string value. come on, man...
-      if isinstance(value, dict):
-        self.find_parameter_values(target_keys, value, found_values)
-      
-      if key in target_keys:
-        value = self.cleanup_fileName(value)
-        found_values[key] = value
-    
-    if 'loras' in target_keys and loras_string:
-      found_values['loras'] = loras_string.strip().strip(',')
+  # values of target_keys in the prompt for job.json export, see PromptIndex.parameters
+  def find_parameter_values(self, target_keys, prompt={}, found_values=None, prompt_index=None):
+    if prompt_index is None: prompt_index = PromptIndex(prompt, self.cleanup_fileName)
+    if found_values is None: found_values = {}
+    found_values.update(prompt_index.parameters(target_keys))
+    if debug: print(f"debug find_parameter_values: {found_values}")
     
     if len(target_keys) == 1:
       return found_values.get(target_keys[0], None)
@@ -372,164 +1618,12 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   # Roman Numerals              'ↁ'       False       False     True
   # --------------------------- --------- ----------- --------- -----------
   # def generate_custom_name: (self, keys_to_extract, prefix, delimiter, prompt, resolution, timestamp=datetime.now(), named_keys=False):
-  def generate_custom_name(self, keys_to_extract, prefix, delimiter, prompt, resolution, timestamp=datetime.now(), named_keys=False):
-    custom_name = []
-
-    # only filename has prefix
-    if prefix:
-      if '%' in prefix:
-        custom_name.append(timestamp.strftime(prefix))
-      else:
-        custom_name.append(prefix)
-    
-    if prompt is not None and keys_to_extract != ['']:
-      found_values = {}
-      if debug: print(f"debug generate_custom_name: --prefix: {prefix}")
-      if debug: print(f"debug generate_custom_name: --keys_to_extract: {keys_to_extract}")
-      if debug: print(f"debug generate_custom_name: --prompt:")
-      
-      # now separating numbered keys from non-numbered keys:
-      #   37.ckpt_name = i want the ckpt_name from node #37
-      #      ckpt_name = i want the ckpt_name from the highest numbered node = the last one found
-      # prompt looks like this:
-      # {'1': {'class_type': 'KSampler',
-      #   'inputs': {'cfg': 1.6, 
-      #     'denoise': 1.0, ...
-      for key in keys_to_extract:
-        # empty comma
-        if not key: continue
-        
-        value = None
-        node, nodeKey = None, None
-        
-        # datetime format
-        if '%' in key:
-          value = timestamp.strftime(key)
-        
-        # check if there is an os.sep involved, cleanup the key
-        if '/' in key:
-          # key is a subfolder: ./key or ../key or /key ==> last / is removed
-          values = re.split('/+', key)
-          # we will strip the last / in all cases
-          if values[0] in ['','.','..']:
-            custom_name.append(values[0]+'/')
-            key = values[1]
-            # was it just a folder separator?
-            if not key: continue
-          else:
-            key = values[0]
-
-        # fixed string:
-        if (key.startswith("'") and key.endswith("'")) or (key.startswith('"') and key.endswith('"')):
-          value = key
-
-        # is it num.key ?
-        if value is None:
-          splitKey = key.split('.')
-          # we also exclude cases like "..string" or "sting.string.x" etc
-          if len(splitKey) == 2:
-            # key has the form string.string
-            if '' not in splitKey:
-              # key has the form string.string
-              if splitKey[0].isdecimal():
-                # key has the form num.widget_name like 123.widget_name, we will then look for widget_name value in node #123
-                node, nodeKey = splitKey[0], splitKey[1]
-                if node in prompt:
-                  if debug: print(f"debug generate_custom_name: --node.nodeKey = {node}.{nodeKey}")
-                  # splitKey[0] = #node number found in prompt, we will recurse only in that node:
-                  if nodeKey == 'ckpt_path':
-                    self.find_keys_recursively(prompt[node], ['ckpt_name', nodeKey], found_values)
-                  elif nodeKey == 'control_net_path':
-                    self.find_keys_recursively(prompt[node], ['control_net_name', nodeKey], found_values)
-                  elif nodeKey == 'lora_path':
-                    self.find_keys_recursively(prompt[node], ['lora_name', nodeKey], found_values)
-                  else:
-                    self.find_keys_recursively(prompt[node], [nodeKey], found_values)
-                else:
-                  # if splitKey[0] = #num node not found in prompt; #num could have changed or user made a typo. Fallback to normal key search
-                  print(f"SaveImageExtended info: node #{node} not found")
-                  if nodeKey == 'ckpt_path':
-                    self.find_keys_recursively(prompt, ['ckpt_name', nodeKey], found_values)
-                  elif nodeKey == 'control_net_path':
-                    self.find_keys_recursively(prompt, ['control_net_name', nodeKey], found_values)
-                  elif nodeKey == 'lora_path':
-                    self.find_keys_recursively(prompt, ['lora_name', nodeKey], found_values)
-                  else:
-                    self.find_keys_recursively(prompt, [nodeKey], found_values)
-              else:
-                # key is in the form string.string = fixed string; still, we remove extra stuff and known extensions
-                value = self.cleanup_fileName(key)
-            else:
-              # key is in the form ".string" or "string." or "." - we won't clean that up and keep as is, maybe it's a separator
-              value = key
-          
-          # key is not a datetime, folder, has no dot, or multiple dots, could be a valid key to find, could be a fixed string - keep as is
-          else:
-            nodeKey = key
-            if nodeKey == 'ckpt_path':
-              self.find_keys_recursively(prompt, ['ckpt_name', nodeKey], found_values)
-            elif nodeKey == 'control_net_path':
-              self.find_keys_recursively(prompt, ['control_net_name', nodeKey], found_values)
-            elif nodeKey == 'lora_path':
-              self.find_keys_recursively(prompt, ['lora_name', nodeKey], found_values)
-            elif nodeKey == 'resolution':
-              value = resolution
-            else:
-              self.find_keys_recursively(prompt, [nodeKey], found_values)
-          # is key num.widget_name
-        # value was None
-          
-        # at this point we have a nodeKey, or a value, or both
-        if debug: print(f"debug generate_custom_name: ----nodeKey:      {nodeKey}")
-        if debug: print(f"debug generate_custom_name: ----value:        {value}")
-        if debug: print(f"debug generate_custom_name: ----found_values: {found_values}")
-        if value is None:
-          if nodeKey is not None:
-            if nodeKey in found_values:
-              if named_keys:
-                value = f"{nodeKey}={found_values[nodeKey]}"
-              else:
-                value = found_values[nodeKey]
-            if value is None: value = nodeKey
-          
-        
-        # at this point, value is not None anymore
-        # now we analyze each value found and format them accordingly:
-        if debug: print(f"debug generate_custom_name: ----value: {value}")
-        
-        # now we build the custom_name:
-        if isinstance(value, str):
-          # prefix and keys can very well be subfolders ending or starting with a /
-          # for subfolders in keys, do not clean the filename...
-          if debug: print(f"debug generate_custom_name: ---------: / in value? {nodeKey}={value}")
-          
-          # Now process the custom cases ckpt_path and control_net_path; maybe we should do that to `image` as well?
-          # The recursive function creates ckpt_path and ckpt_name already; we just need to eliminate path if == '.'
-          if nodeKey in ['ckpt_path', 'control_net_path', 'lora_path']:
-            # smth_path is most likely placed before smth_name, therefore value cannot be resolved during the previous check
-            value = found_values[nodeKey]
-          else:
-            value = self.cleanup_fileName(value)
-        elif isinstance(value, float):
-          # value = round(float(value), 1)  # too much rounding
-          value = float(f'{value:.10g}')
-        
-        custom_name.append(str(value))
-        if debug: print(f"debug generate_custom_name: ------custom_name: {custom_name}")
-      # for each key
-    
-    # remove empty values
-    custom_name = list(filter(None, custom_name))
-    # strip each item
-    custom_name = list(map(str.strip, custom_name))
-    # join
-    stringName = delimiter.join(custom_name).replace('/'+delimiter, '/').replace(delimiter+'/', '/').replace(delimiter+'.', '.')
-    # clean and remove line feeds
-    stringName = re.sub('\s+',' ',stringName).strip(delimiter).strip('/').strip(delimiter).strip('.')
-
-    if debug: print(f"debug generate_custom_name: ------custom_name: {custom_name}")
-    if debug: print(f"debug generate_custom_name: ------stringName:  {stringName}")
-    return re.sub(r'[*?:"<>|]','',stringName).replace('/', os.sep)
+  # keys_to_extract is the raw filename_keys/foldername_keys string, or the list of its keys
+  def generate_custom_name(self, keys_to_extract, prefix, delimiter, prompt, resolution, timestamp=datetime.now(), named_keys=False, prompt_index=None):
+    if isinstance(keys_to_extract, (list, tuple)): keys_to_extract = ','.join(keys_to_extract)
+    template = compile_name_template(keys_to_extract, delimiter, named_keys)
+    if prompt is not None and prompt_index is None and template.tokens: prompt_index = PromptIndex(prompt, self.cleanup_fileName)
+    return template.render(prefix, prompt, prompt_index, resolution, timestamp, self.cleanup_fileName)
   
   
   
@@ -541,7 +1635,77 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   # ██   ██      ██ ██    ██ ██  ██ ██ 
   #  █████  ███████  ██████  ██   ████ 
 
-  def save_job_to_json(self, save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, filename, timestamp=datetime.now()):
+  def save_job_to_json(self, save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, filename, timestamp=datetime.now(), prompt_index=None):
+    prompt_keys_to_save = self.genJobData(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index)
+    
+    # Append data and save
+    json_file_path = os.path.join(output_path, filename)
+    if filename.endswith('.jsonl'):
+      # job_log_format = 'jsonl': one line per job, appended with a single write. No read, a crash can only cut the last line
+      line = json.dumps({'timestamp': timestamp.isoformat(), 'job': prompt_keys_to_save}) + '\n'
+      fd = os.open(json_file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o666)
+      try:
+        os.write(fd, line.encode('utf-8'))
+        if self.durability != 'none': os.fsync(fd)
+      finally:
+        os.close(fd)
+      return
+    
+    existing_data = {}
+    if os.path.exists(json_file_path):
+      try:
+        with open(json_file_path, 'r') as f:
+          existing_data = json.load(f)
+      except json.JSONDecodeError:
+        print(f"SaveImageExtended {version} error: The file {json_file_path} is empty or malformed. Initializing with empty data.")
+        existing_data = {}
+    
+    set_time_locale()
+    timestamp = timestamp.strftime('%c')
+    new_entry = {}
+    new_entry[timestamp] = prompt_keys_to_save
+    existing_data.update(new_entry)
+    
+    # a kill during the write cannot truncate jobs.json anymore, and lose every job in it on the next read
+    write_file_atomic(json_file_path, json.dumps(existing_data, indent=4).encode('utf-8'), self.durability != 'none')
+  
+  
+  # catalog columns shared by every image of a save_images call
+  def genCatalogRow(self, width, height, timestamp, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index=None):
+    job = self.genJobData('basic, models, sampler, prompt', prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index)
+    sampler = job.get('sampler_parameters', {})
+    # linked widgets end up as [node, slot]: only plain values are searchable
+    def column(value):
+      return value if value is None or isinstance(value, (str, int, float)) else json.dumps(value)
+    return {
+      'width': width,
+      'height': height,
+      'timestamp': timestamp.isoformat(),
+      **{key: column(sampler.get(key)) for key in ['seed', 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise']},
+      **{key: column(job.get(key)) for key in ['checkpoint', 'loras', 'vae', 'positive_prompt', 'negative_prompt']},
+      'job': json.dumps(job),
+    }
+  
+  
+  # catalogued: [(image_path, counter)] of files on disk, one transaction for all of them
+  def catalogImages(self, row, catalogued):
+    rows = list()
+    for image_path, counter in catalogued:
+      rows.append({**row,
+        'path': os.path.relpath(image_path, self.output_dir).replace(os.sep, '/'),
+        'counter': counter,
+        'format': Path(image_path).suffix.lstrip('.'),
+        'size': os.path.getsize(image_path),
+      })
+    try:
+      output_catalog.insert(os.path.join(self.output_dir, self.catalog_name), rows)
+    except sqlite3.Error as e:
+      print(f"SaveImageExtended {version} error: could not update the catalog {self.catalog_name}: {e}")
+  
+  
+  # the job entry of jobs.json, jobs.jsonl or of an archive shard
+  def genJobData(self, save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index=None):
+    if prompt_index is None: prompt_index = PromptIndex(prompt, self.cleanup_fileName)
     prompt_keys_to_save = {}
     if 'basic' in save_job_data:
       if len(filename_prefix) > 0:
@@ -551,7 +1715,7 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       prompt_keys_to_save['custom_text'] = job_custom_text
     
     if 'models' in save_job_data:
-      models = self.find_parameter_values(['ckpt_name', 'loras', 'vae_name', 'model_name'], prompt)
+      models = self.find_parameter_values(['ckpt_name', 'loras', 'vae_name', 'model_name'], prompt, prompt_index=prompt_index)
       if models.get('ckpt_name'):
         prompt_keys_to_save['checkpoint'] = models['ckpt_name']
       if models.get('loras'):
@@ -562,7 +1726,7 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
         prompt_keys_to_save['upscale_model'] = models['model_name']
     
     if 'sampler' in save_job_data:
-      prompt_keys_to_save['sampler_parameters'] = self.find_parameter_values(['seed', 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise'], prompt)
+      prompt_keys_to_save['sampler_parameters'] = self.find_parameter_values(['seed', 'steps', 'cfg', 'sampler_name', 'scheduler', 'denoise'], prompt, prompt_index=prompt_index)
     
     if 'prompt' in save_job_data:
       if positive_text_opt is not None:
@@ -615,24 +1779,7 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
                         continue
                 prompt_keys_to_save['negative_prompt'] = negative_text
     
-    # Append data and save
-    json_file_path = os.path.join(output_path, filename)
-    existing_data = {}
-    if os.path.exists(json_file_path):
-      try:
-        with open(json_file_path, 'r') as f:
-          existing_data = json.load(f)
-      except json.JSONDecodeError:
-        print(f"SaveImageExtended {version} error: The file {json_file_path} is empty or malformed. Initializing with empty data.")
-        existing_data = {}
-    
-    timestamp = timestamp.strftime('%c')
-    new_entry = {}
-    new_entry[timestamp] = prompt_keys_to_save
-    existing_data.update(new_entry)
-    
-    with open(json_file_path, 'w') as f:
-      json.dump(existing_data, f, indent=4)
+    return prompt_keys_to_save
   
   
 
@@ -643,16 +1790,28 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   # ██      ██  ██ ██ ██    ██ 
   # ██      ██   ████  ██████  
 
+  # above metadata_compress_threshold, texts go in zTXt chunks: same keys, zlib compressed, PNG readers decompress them transparently.
+  # prompt and workflow always stay tEXt: ComfyUI only loads a dropped PNG's workflow from tEXt chunks
   def genMetadataPng(self, img, prompt, extra_pnginfo=None):
     metadata = PngInfo()
+    threshold = self.metadata_compress_threshold
     if prompt is not None:
       metadata.add_text('prompt', json.dumps(prompt))
     if extra_pnginfo is not None:
       for x in extra_pnginfo:
-        metadata.add_text(x, json.dumps(extra_pnginfo[x]))
+        text = json.dumps(extra_pnginfo[x])
+        metadata.add_text(x, text, zip=x != 'workflow' and 0 < threshold <= len(text))
     
     return metadata
   
+  # EXIF tags are plain strings: above metadata_compress_threshold the json is zlib compressed, base64 encoded, and marked as such:
+  #   Prompt: zlib+base64:eJzNVMtu2zAQ...
+  def genMetadataEXIFText(self, text):
+    threshold = self.metadata_compress_threshold
+    if 0 < threshold <= len(text):
+      return metadata_compressed_marker + base64.b64encode(zlib.compress(text.encode('utf-8'), 9)).decode('ascii')
+    return text
+  
   # ███████ ██   ██ ██ ███████ 
   # ██       ██ ██  ██ ██      
   # █████     ███   ██ █████   
@@ -678,8 +1837,8 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
     #   valueOffset 26
     ## Also when Comfy pnginfo.js reads it, all the quotes are escaped, making the prompt invalid
     ## exif type is PIL.Image.Exif
-    exif = img.getexif()
-    dump = json.dumps(metadata)
+    exif = img.getexif() if img is not None else Image.Exif()
+    # dump = json.dumps(metadata)
     # print(f"dump={dump}")   {"prompt": { .. }, "workflow": { .. }}
     # exif[ExifTags.Base.UserComment] = dump
     
@@ -691,8 +1850,8 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
     # both prompt and workflow must be in IFD close together of that can cause problems for the parseIFD function on import
     # https://exiftool.org/TagNames/EXIF.html
     # exif[0x9286] = "Prompt: " + json.dumps(metadata['prompt'])     # UserComment
-    exif[0x010f] = "Prompt: " + json.dumps(metadata['prompt'])     # Make
-    exif[0x010e] = "Workflow: " + json.dumps(metadata.get('workflow', {})) # ImageDescription
+    exif[0x010f] = "Prompt: " + self.genMetadataEXIFText(json.dumps(metadata['prompt']))     # Make
+    exif[0x010e] = "Workflow: " + self.genMetadataEXIFText(json.dumps(metadata.get('workflow', {}))) # ImageDescription
     
     # exif[ExifTags.Base.UserComment] = piexif.helper.UserComment.dump(json.dumps(metadata), encoding="unicode")  # type 4
     # exif[ExifTags.Base.UserComment] = piexif.helper.UserComment.dump(json.dumps(metadata), encoding="jis")      # type 1
@@ -734,13 +1893,123 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
   # ██ ███ ██ ██   ██ ██    ██    ██      
   #  ███ ███  ██   ██ ██    ██    ███████ 
 
-  def writeImage(self, image_path, img, prompt, save_metadata=save_metadata, extra_pnginfo=None, quality=quality):
+  # kwargs: encoder options from genEncoderKwargs, built once per batch by save_images. The prompt/workflow serialization is the costly part. Returns the encode time in seconds
+  def writeImage(self, image_path, img, prompt, save_metadata=save_metadata, extra_pnginfo=None, quality=quality, kwargs=None):
     if debug: print(f"debug writeImage: image_path={image_path}")
-    if quality == 0:
-      quality = self.quality
     # output_ext = os.path.splitext(os.path.basename(image_path))[1]
     output_ext = Path(image_path).suffix
-    metadata = None
+    if kwargs is None: kwargs = self.genEncoderKwargs(output_ext, img, prompt, save_metadata, extra_pnginfo, quality)
+    
+    # BUG: PIL.Image doesn't respect compress_level value and always output max 9 compressed images when optimize_image = True
+    # img.save(image_path, pnginfo=metadata, compress_level=png_compress_level)
+    start = time.perf_counter()
+    data = encode_image(img, output_ext, kwargs)
+    write_file_atomic(image_path, data, self.durability != 'none')
+    
+    # Is saving image with OpenCV really faster then PIL? https://github.com/python-pillow/Pillow/issues/5986
+    # I found that it does not matter for anything smaller then 8k*8k, which Comfy cannot produce anyways.
+    # compression_level = [cv2.IMWRITE_PNG_COMPRESSION, png_compress_level]
+    # image_array = numpy.array(img)
+    # image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+    # cv2.imwrite(image_path.replace('000','cv2'), image_array)
+    
+    seconds = time.perf_counter() - start
+    save_metrics.wrote(output_ext, len(data), seconds)
+    return seconds
+  
+  
+  # large_image_pixels: frame is still a tensor, it is converted and encoded strip by strip. PNG and TIFF (with tifffile installed)
+  # never hold the whole frame in uint8; other formats get it in uint8, never as float. Returns the encode time in seconds
+  def writeLarge(self, image_path, frame, kwargs):
+    if debug: print(f"debug writeLarge: image_path={image_path}")
+    output_ext = Path(image_path).suffix
+    # TIFF tiles are multiples of 16
+    tile = max(self.large_image_tile // 16 * 16, 16)
+    start = time.perf_counter()
+    with atomic_file(image_path, self.durability != 'none') as f:
+      if output_ext == '.png':
+        write_png_strips(f, frame, tile, kwargs.get('compress_level', 6), kwargs.get('pnginfo'))
+      elif output_ext == '.tiff' and tifffile_available():
+        write_tiff_tiles(f, frame, tile)
+      else:
+        if output_ext in ['.j2k', '.jp2', '.jpc', '.jpf', '.jpx', '.j2c']:
+          # OpenJPEG encodes tile by tile; up to 6 resolution levels, a level cannot be smaller than one pixel of a tile
+          kwargs = {**kwargs, 'tile_size': (tile, tile), 'num_resolutions': min(6, tile.bit_length())}
+        load_codec(output_ext)
+        Image.fromarray(frame_to_uint8(frame, tile)).save(f, format=Image.registered_extensions()[output_ext], **kwargs)
+      size = f.tell()
+    seconds = time.perf_counter() - start
+    save_metrics.wrote(output_ext, size, seconds)
+    return seconds
+  
+  
+  # batch_as_sequence: every frame in one animated (WebP/AVIF/GIF/PNG) or multi-page (TIFF) file, metadata embedded once.
+  # Returns the encode time in seconds
+  def writeSequence(self, image_path, frames, kwargs, frame_duration=frame_duration):
+    if debug: print(f"debug writeSequence: image_path={image_path} frames={len(frames)}")
+    output_ext = Path(image_path).suffix
+    images = [Image.fromarray(frame) for frame in frames]
+    start = time.perf_counter()
+    # TIFF pages ignore duration and loop
+    data = encode_image(images[0], output_ext, kwargs, save_all=True, append_images=images[1:], duration=frame_duration, loop=0)
+    write_file_atomic(image_path, data, self.durability != 'none')
+    seconds = time.perf_counter() - start
+    save_metrics.wrote(output_ext, len(data), seconds)
+    return seconds
+  
+  
+  # encode a batch on every core: jobs = [(index, image_path)] in frames, the uint8 batch from images_to_uint8.
+  # The counter and image_path were decided by save_images. Returns the encode time of each image
+  def writeImagesParallel(self, jobs, frames, prompt, save_metadata=save_metadata, extra_pnginfo=None, quality=quality, kwargs=None):
+    output_ext = Path(jobs[0][1]).suffix
+    # the batch shares the same prompt, same metadata and same encoder options
+    if kwargs is None: kwargs = self.genEncoderKwargs(output_ext, None, prompt, save_metadata, extra_pnginfo, quality)
+    shape = frames.shape
+    shm = shared_memory.SharedMemory(create=True, size=frames.nbytes)
+    try:
+      shared_frames = numpy.ndarray(shape, dtype=numpy.uint8, buffer=shm.buf)
+      shared_frames[:] = frames
+      del shared_frames
+      
+      # in the parent: the workers find the plugin loaded and never take codecs_lock
+      load_codec(output_ext)
+      pool = get_encode_pool(self.parallel_workers)
+      futures = [pool.submit(encode_shared_frame, shm.name, shape, index, image_path, kwargs, self.durability != 'none') for index, image_path in jobs]
+      # the shared memory must outlive every job, even when one fails
+      wait(futures)
+      timings = list()
+      for future in futures:
+        seconds, size = future.result()
+        save_metrics.wrote(output_ext, size, seconds)
+        timings.append(seconds)
+    finally:
+      shm.close()
+      shm.unlink()
+    return timings
+  
+  
+  # extra_formats: '.avif:80, .png' = [('.avif', 80), ('.png', quality)]. Unknown formats and output_ext itself are skipped
+  def genExtraFormats(self, extra_formats, output_ext, quality=quality):
+    formats = list()
+    for item in extra_formats.split(','):
+      ext, _, extra_quality = item.strip().lower().partition(':')
+      if not ext: continue
+      if not ext.startswith('.'): ext = f'.{ext}'
+      if ext not in self.output_exts:
+        print(f"SaveImageExtended {version} info: extra format {ext} is not supported, skipped")
+        continue
+      if ext == output_ext or ext in [found for found, _ in formats]: continue
+      if extra_quality.strip().isdecimal() and 1 <= int(extra_quality) <= 100:
+        formats.append((ext, int(extra_quality)))
+      else:
+        formats.append((ext, quality))
+    return formats
+  
+  
+  # img.save() keyword arguments for output_ext. img can be None when the image is encoded elsewhere, see encode_shared_frame
+  def genEncoderKwargs(self, output_ext, img, prompt, save_metadata=save_metadata, extra_pnginfo=None, quality=quality, encode_speed=encode_speed):
+    if quality == 0:
+      quality = self.quality
     kwargs = dict()
     
     # TODO: see if convert_hdr_to_8bit=False make a change
@@ -787,17 +2056,216 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       # kwargs["optimize"] = self.optimize_image
     # elif output_ext in ['.bmp']:
       # nothing to add
-      
-    # BUG: PIL.Image doesn't respect compress_level value and always output max 9 compressed images when optimize_image = True
-    # img.save(image_path, pnginfo=metadata, compress_level=png_compress_level)
-    img.save(image_path, **kwargs)
+    
+    kwargs.update(self.encode_presets.get(output_ext, {}).get(encode_speed, {}))
+    return kwargs
 
-    # Is saving image with OpenCV really faster then PIL? https://github.com/python-pillow/Pillow/issues/5986
-    # I found that it does not matter for anything smaller then 8k*8k, which Comfy cannot produce anyways.
-    # compression_level = [cv2.IMWRITE_PNG_COMPRESSION, png_compress_level]
-    # image_array = numpy.array(img)
-    # image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
-    # cv2.imwrite(image_path.replace('000','cv2'), image_array)
+
+  def genImageName(self, filename, filename_prefix, delimiter, counter, counter_digits, counter_position, output_ext):
+    if counter_digits > 0:
+      # issue/48
+      if filename:
+        if counter_position == 'last':
+          return f'{filename}{delimiter}{counter:0{counter_digits}}{output_ext}'
+        else:
+          return f'{counter:0{counter_digits}}{delimiter}{filename}{output_ext}'
+      else:
+        return f'{counter:0{counter_digits}}{output_ext}'
+    else:
+      # issue/48
+      if filename:
+        return f'{filename}{output_ext}'
+      else:
+        return f'{filename_prefix}{output_ext}'
+  
+  
+  # img encoded in memory, as output_ext would be written by writeImage
+  def encodeImage(self, img, output_ext, kwargs):
+    return encode_image(img, output_ext, kwargs)
+  
+  
+  # downscaled copy of frame, longest side preview_proxy_size
+  def genPreviewImage(self, frame):
+    height, width = frame.shape[:2]
+    size = self.preview_proxy_size
+    img = Image.fromarray(frame)
+    if max(width, height) > size:
+      scale = size / max(width, height)
+      img = img.resize((max(round(width * scale), 1), max(round(height * scale), 1)), Image.Resampling.BILINEAR, reducing_gap=2.0)
+    return img
+  
+  
+  # preview_proxy: small WebP written in ComfyUI's temp folder, returned in ui.images in place of the output itself.
+  # ComfyUI already serves the temp folder (/view?type=temp) and empties it at startup.
+  # Returns None when the output is small enough and in a format the browser can show, unless force: the output cannot be served
+  def savePreviewProxy(self, frame, image_name, output_ext, force=False):
+    height, width = frame.shape[:2]
+    size = self.preview_proxy_size
+    if max(width, height) <= size and output_ext in self.browser_exts and not force:
+      return None
+    
+    img = self.genPreviewImage(frame)
+    temp_dir = folder_paths.get_temp_directory()
+    os.makedirs(temp_dir, exist_ok=True)
+    preview_name = f"{Path(image_name).stem}_{uuid.uuid4().hex[:8]}.webp"
+    img.save(os.path.join(temp_dir, preview_name), quality=self.preview_proxy_quality)
+    return { 'filename': preview_name, 'subfolder': '', 'type': 'temp'}
+
+
+  # dedup: what makes two outputs identical besides the pixels. The metadata is in there: same pixels from another prompt are not duplicates
+  def genEncoderDigest(self, output_ext, kwargs):
+    digest = hashlib.blake2b(output_ext.encode('utf-8'), digest_size=20)
+    for key in sorted(kwargs):
+      value = kwargs[key]
+      if isinstance(value, PngInfo): value = value.chunks
+      digest.update(f'{key}={value!r};'.encode('utf-8'))
+    return digest.digest()
+  
+  
+  # dedup = 'hardlink' / 'symlink': image_path becomes a link to existing. False when the filesystem refuses, the image is then encoded
+  def linkImage(self, existing, image_path):
+    try:
+      if self.dedup == 'hardlink':
+        os.link(existing, image_path)
+      else:
+        os.symlink(os.path.relpath(existing, os.path.dirname(image_path)), image_path)
+    except OSError as e:
+      print(f"SaveImageExtended {version} info: cannot link {image_path} to {existing}, saving it again: {e}")
+      return False
+    if debug: print(f"debug linkImage: {image_path} -> {existing}")
+    return True
+  
+  
+  # archive_format: the batch goes to the shard of the folder. The counters are reserved in a counter file under their own
+  # 'archive' keys, the images are not in the folder to be counted: the counter file of loose images only when reserve_counters is on,
+  # archive_counter_file_name otherwise. The UI gets preview proxies, /view cannot read inside a shard
+  def saveArchive(self, frames, output_path, filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext, encoder_kwargs, archive_format, job, image_preview, timer):
+    counter = 0
+    counter_file = counter_file_name if self.reserve_counters else archive_counter_file_name
+    if counter_digits > 0:
+      key = ('archive',) + self.counter_key(filename, counter_digits, counter_position, output_ext)
+      counter = reserve_counters(output_path, key, len(frames), lambda: self.get_latest_counter(output_path, filename, counter_digits, counter_position, output_ext), counter_file)
+    timer.lap('counter')
+    
+    samples = list()
+    results = list()
+    for frame in frames:
+      image_name = self.genImageName(filename, filename_prefix, delimiter, counter, counter_digits, counter_position, output_ext)
+      samples.append((image_name, frame))
+      if image_preview: results.append(self.saveArchivePreview(frame, image_name))
+      counter += 1
+    timer.lap('preview')
+    
+    if self.async_write:
+      # no image file: the shards of the folder are named in errors instead
+      get_async_writer(self.async_workers, self.async_queue_depth).submit([], self.writeArchive, output_path, archive_format, samples, output_ext, encoder_kwargs, job,
+        label=f"{len(samples)} images in the {archive_format} shards of {output_path}")
+    else:
+      self.writeArchive(output_path, archive_format, samples, output_ext, encoder_kwargs, job)
+    timer.lap('write')
+    return results
+  
+  
+  # archive_format: the small WebP shown by the node lives in preview_cache, not in the temp folder:
+  # millions of dataset images would make millions of temp files again. Marked archived, there is nothing to persist
+  def saveArchivePreview(self, frame, image_name):
+    display = self.encodeImage(self.genPreviewImage(frame), '.webp', {'quality': self.preview_proxy_quality})
+    key = preview_cache.put({
+      'data': display,
+      'display': display,
+      'content_type': 'image/webp',
+      'archived': True,
+    }, self.preview_cache_bytes)
+    return {'key': key, 'filename': image_name, 'archived': True}
+  
+  
+  # samples = [(image_name, frame)], job = the json bytes stored next to each image, or None
+  def writeArchive(self, folder_path, archive_format, samples, output_ext, kwargs, job=None):
+    for image_name, frame in samples:
+      start = time.perf_counter()
+      data = self.encodeImage(Image.fromarray(frame), output_ext, kwargs)
+      save_metrics.wrote(output_ext, len(data), time.perf_counter() - start)
+      members = [(image_name, data)]
+      if job is not None: members.append((f'{image_name.removesuffix(output_ext)}.json', job))
+      shard_path = archive_shards.add(folder_path, archive_format, members, self.archive_shard_name, self.archive_shard_bytes, self.archive_shard_count,
+        counter_file_name if self.reserve_counters else archive_counter_file_name)
+      if debug: print(f"debug writeArchive: {image_name} in {shard_path}")
+  
+  
+  # one line per call when metrics_log = True, the same numbers go to /save_image_extended/metrics
+  def recordMetrics(self, timer, count, output_ext, resolution):
+    save_metrics.record(timer)
+    if self.metrics_log:
+      stages = ' '.join(f'{stage} {seconds * 1000:.1f}' for stage, seconds in timer.stages.items())
+      print(f"SaveImageExtended {version}: {count} x {resolution} {output_ext} in {timer.elapsed() * 1000:.1f}ms | {stages} (ms)")
+  
+  
+  # preview_only: the images are encoded in memory and kept in preview_cache, served by /save_image_extended/preview/{key}.
+  # No folder, no counter, no file until persistPreviews is called from the node menu.
+  def savePreviewOnly(self, frames, output_path, filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext, encoder_kwargs, job):
+    previews = list()
+    batch = uuid.uuid4().hex
+    for frame in frames:
+      img = Image.fromarray(frame)
+      data = self.encodeImage(img, output_ext, encoder_kwargs)
+      # what the browser cannot show gets a WebP to look at
+      display = data if output_ext in self.browser_exts else self.encodeImage(self.genPreviewImage(frame), '.webp', {'quality': self.preview_proxy_quality})
+      key = preview_cache.put({
+        'data': data,
+        'display': display,
+        'content_type': mimetypes.guess_type(f'image{output_ext}')[0] if display is data else 'image/webp',
+        'output_path': output_path,
+        'name': (filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext),
+        'job': job,
+        'batch': batch,
+      }, self.preview_cache_bytes)
+      previews.append({'key': key, 'filename': self.genImageName(filename, filename_prefix, delimiter, 0, counter_digits, counter_position, output_ext)})
+    # not under 'images': the frontend would look for them in /view
+    return { 'ui': { 'save_image_extended_previews': previews } }
+  
+  
+  # writes the previews still in preview_cache, with the counter they get now. Returns the ui.images entries of what was written
+  def persistPreviews(self, keys):
+    results = list()
+    jobs_written = set()
+    for key in keys:
+      written = list()
+      entry = preview_cache.get(key)
+      if entry is None:
+        print(f"SaveImageExtended {version} info: preview {key} is not in memory anymore, it cannot be saved")
+        continue
+      # archive_format previews: the image is already in a shard
+      if entry.get('archived'): continue
+      preview_cache.pop(key)
+      output_path = entry['output_path']
+      filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext = entry['name']
+      os.makedirs(output_path, exist_ok=True)
+      counter = self.get_latest_counter(output_path, filename, counter_digits, counter_position, output_ext)
+      image_name = self.genImageName(filename, filename_prefix, delimiter, counter, counter_digits, counter_position, output_ext)
+      image_path = os.path.join(output_path, image_name)
+      write_file_atomic(image_path, entry['data'], self.durability != 'none')
+      save_metrics.wrote(output_ext, len(entry['data']))
+      written.append(image_path)
+      counter_index.reserve(output_path, self.counter_key(filename, counter_digits, counter_position, output_ext), counter + 1)
+      
+      if entry['job'] is not None:
+        job_args, job_data_per_image, job_ext = entry['job']
+        if job_data_per_image:
+          job_filename = f'{image_name.removesuffix(output_ext)}{job_ext}'
+        elif entry['batch'] not in jobs_written:
+          job_filename = f'jobs{job_ext}'
+          jobs_written.add(entry['batch'])
+        else:
+          job_filename = None
+        if job_filename:
+          save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, timestamp, prompt_index = job_args
+          self.save_job_to_json(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, job_filename, timestamp, prompt_index)
+          written.append(os.path.join(output_path, job_filename))
+      
+      results.append({ 'filename': image_name, 'subfolder': self.get_subfolder_path(image_path, self.output_dir), 'type': self.type})
+      # the folder mtime moved: accept it now, or the next preview would rescan the folder
+      counter_index.files_written(written)
+    return results
 
 
   # ███████  █████  ██    ██ ███████ 
@@ -829,6 +2297,13 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       prompt=None,
       quality=quality,
       named_keys=named_keys,
+      preview_only=False,
+      encode_speed=encode_speed,
+      encode_budget_ms=encode_budget_ms,
+      batch_as_sequence=batch_as_sequence,
+      frame_duration=frame_duration,
+      archive_format=archive_format,
+      extra_formats=extra_formats,
     ):
     
     if debug: 
@@ -850,20 +2325,32 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
     # if not filename_prefix and not filename_keys: filename_prefix=self.filename_prefix
     if delimiter: delimiter = delimiter[0]
     
-    filename_keys_to_extract = [item.strip() for item in filename_keys.split(',')]
-    foldername_keys_to_extract = [item.strip() for item in foldername_keys.split(',')]
-    
     ################################## UNCOMMENT HERE TO SEE THE ENTIRE PROMPT
     # pprint.pprint(prompt)
     ##########################################################################
+    timer = StageTimer()
     # Get set resolution value - that's a secret keyword
-    i = 255. * images[0].cpu().numpy()
-    img = Image.fromarray(numpy.clip(i, 0, 255).astype(numpy.uint8))
-    resolution = f'{img.width}x{img.height}'
+    # large_image_pixels and stream_frames: only one file per image, the other modes need the whole batch at once
+    single = (not preview_only and not self.parallel_encode
+      and not (batch_as_sequence and output_ext in self.sequence_exts) and archive_format not in self.archive_formats[1:])
+    large = single and self.large_image_pixels > 0 and images.shape[1] * images.shape[2] >= self.large_image_pixels
+    stream = single and not large and self.stream_frames > 0 and len(images) >= self.stream_frames
+    if large:
+      # converted strip by strip when written
+      frames = images
+    elif stream:
+      frames = FrameStream(images, self.stream_depth)
+    else:
+      frames = images_to_uint8(images)
+    resolution = f'{frames.shape[2]}x{frames.shape[1]}'
+    timer.lap('convert')
     
     timestamp = datetime.now()
-    custom_foldername = self.generate_custom_name(foldername_keys_to_extract, foldername_prefix, delimiter, prompt, resolution, timestamp, named_keys)
-    custom_filename = self.generate_custom_name(filename_keys_to_extract, filename_prefix, delimiter, prompt, resolution, timestamp, named_keys)
+    # the prompt is walked only once, for folder, file and job data
+    prompt_index = PromptIndex(prompt, self.cleanup_fileName)
+    custom_foldername = self.generate_custom_name(foldername_keys, foldername_prefix, delimiter, prompt, resolution, timestamp, named_keys, prompt_index)
+    custom_filename = self.generate_custom_name(filename_keys, filename_prefix, delimiter, prompt, resolution, timestamp, named_keys, prompt_index)
+    timer.lap('names')
     
     # Create folders, count images, save images
     try:
@@ -883,46 +2370,262 @@ ComfyUI can only load PNG and WebP at the moment, AVIF is a PR that was sadly dr
       if debug: print(f"debug save_images: output_path=        {output_path}")
       if debug: print(f"debug save_images: filename=           {filename}")
       
+      job_ext = '.jsonl' if self.job_log_format == 'jsonl' else '.json'
+      # every image of the batch shares the prompt and workflow: EXIF bytes or PNG chunks are serialized only once
+      if encode_budget_ms > 0 and output_ext in self.encode_presets:
+        encode_speed = encode_budget.choose(output_ext, self.encode_speeds[1:], frames.shape[1] * frames.shape[2], encode_budget_ms / 1000)
+        if debug: print(f"debug save_images: encode_speed=       {encode_speed} (budget {encode_budget_ms}ms)")
+      encoder_kwargs = self.genEncoderKwargs(output_ext, None, prompt, save_metadata, extra_pnginfo, quality, encode_speed)
+      # encode times of each preset, for encode_budget_ms
+      def encoded(seconds):
+        if encode_speed in self.encode_presets.get(output_ext, {}):
+          encode_budget.observe(output_ext, encode_speed, seconds, frames.shape[1] * frames.shape[2])
+      timer.lap('metadata')
+      if preview_only:
+        job = None
+        if save_job_data != 'disabled':
+          job = ((save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, timestamp, prompt_index), job_data_per_image, job_ext)
+        previews = self.savePreviewOnly(frames, output_path, filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext, encoder_kwargs, job)
+        timer.lap('preview')
+        self.recordMetrics(timer, len(frames), output_ext, resolution)
+        return previews
+      
+      # batch_as_sequence: one file for the whole batch, named and counted like its first image
+      sequence = batch_as_sequence and len(frames) > 1 and output_ext in self.sequence_exts
+      if batch_as_sequence and output_ext not in self.sequence_exts: print(f"SaveImageExtended {version} info: {output_ext} cannot hold a sequence, saving one file per image")
+      
       os.makedirs(output_path, exist_ok=True)
-      counter = self.get_latest_counter(output_path, filename, counter_digits, counter_position, output_ext)
+      # stream: the writer threads are the encode stage, save_images still waits for them
+      background = self.async_write or stream
+      if background:
+        writer = get_async_writer(self.async_workers, self.async_queue_depth)
+        submit = writer.submit if self.async_write else writer.submit_waited
+      if archive_format in self.archive_formats[1:]:
+        job = None
+        if save_job_data != 'disabled':
+          job = self.genJobData(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index)
+          job = json.dumps({'timestamp': timestamp.isoformat(), 'job': job}).encode('utf-8')
+        results = self.saveArchive(frames, output_path, filename, filename_prefix, delimiter, counter_digits, counter_position, output_ext, encoder_kwargs, archive_format, job, image_preview, timer)
+        self.recordMetrics(timer, len(frames), output_ext, resolution)
+        # served from preview_cache like preview_only
+        return { 'ui': { 'save_image_extended_previews': results } }
+      # extra_formats: one encoder setup per format, the conversion, names, counter and metadata are shared
+      extras = [(extra_ext, self.genEncoderKwargs(extra_ext, None, prompt, save_metadata, extra_pnginfo, extra_quality, encode_speed)) for extra_ext, extra_quality in self.genExtraFormats(extra_formats, output_ext, quality)]
+      if extras and sequence:
+        print(f"SaveImageExtended {version} info: extra_formats are not saved with batch_as_sequence")
+        extras = list()
+      timer.lap('metadata')
+      
+      # folder_shard_files: images and job files go in the current shard, counters are reserved in the folder itself
+      counter_path = output_path
+      previous_shard = None
+      if self.folder_shard_files > 0:
+        files = 1 if sequence else len(frames) * (1 + len(extras))
+        if save_job_data != 'disabled' and job_data_per_image: files *= 2
+        output_path, previous_shard = folder_shards.place(output_path, files, self.folder_shard_files, self.folder_shard_digits)
+        os.makedirs(output_path, exist_ok=True)
+        if debug: print(f"debug save_images: output_path=        {output_path} (shard)")
+      # every format shares the counter: the next one free for all of them
+      def latest_counter():
+        counter = 1
+        for ext in [output_ext] + [extra_ext for extra_ext, _ in extras]:
+          counter = max(counter, self.get_latest_counter(output_path, filename, counter_digits, counter_position, ext))
+          # a new shard has no counter yet: continue the previous one
+          if previous_shard is not None: counter = max(counter, self.get_latest_counter(previous_shard, filename, counter_digits, counter_position, ext))
+        return counter
+      if self.reserve_counters and counter_digits > 0:
+        key = self.counter_key(filename, counter_digits, counter_position, output_ext)
+        counter = reserve_counters(counter_path, key, 1 if sequence else len(frames), latest_counter)
+      else:
+        counter = latest_counter()
+      timer.lap('counter')
     
       results = list()
-      for image in images:
-        i = 255. * image.cpu().numpy()
-        img = Image.fromarray(numpy.clip(i, 0, 255).astype(numpy.uint8))
+      parallel = self.parallel_encode and len(images) > 1 and not sequence
+      dedup = self.dedup in self.dedup_modes[1:] and not sequence and not large
+      if dedup:
+        encoder_digest = self.genEncoderDigest(output_ext, encoder_kwargs)
+        extra_digests = {extra_ext: self.genEncoderDigest(extra_ext, extra_kwargs) for extra_ext, extra_kwargs in extras}
+      hashes = list()
+      jobs = list()
+      written = list()
+      submitted = list()    # async_write: [(future, image paths)]
+      catalogued = list()   # catalog: [(image path, counter)]
+      extra_jobs = {}       # parallel_encode: {extra format: [(index, image path)]}
+      extra_hashes = {}     # parallel_encode and dedup: {extra format: [(digest, image path)]}
+      fanout = list()       # extra formats written right now: [future]
+      fanout_pool = None
+      if extras and not parallel and not background: fanout_pool = ThreadPoolExecutor(max_workers=len(extras), thread_name_prefix='save_image_extended_formats')
+      for index, frame in enumerate(frames[:1] if sequence else frames):
+        if not parallel and not sequence and not large:
+          # a view on frames: no float intermediate, no extra numpy copy
+          img = Image.fromarray(frame)
+        
+        image_name = self.genImageName(filename, filename_prefix, delimiter, counter, counter_digits, counter_position, output_ext)
+        image_path = os.path.join(output_path, image_name)
+        existing = None
+        if dedup:
+          digest = dedup_digest(frame, encoder_digest)
+          existing = dedup_index.find(self.output_dir, digest)
         
-        if counter_digits > 0:
-          # issue/48
-          if filename:
-            if counter_position == 'last':
-              image_name = f'{filename}{delimiter}{counter:0{counter_digits}}{output_ext}'
+        # extra formats go first: their encodes run while the main one is encoded below.
+        # dedup is per format: the main format saved before says nothing about the extra ones
+        extras_saved = 0
+        for extra_ext, extra_kwargs in extras:
+          extra_path = os.path.join(output_path, self.genImageName(filename, filename_prefix, delimiter, counter, counter_digits, counter_position, extra_ext))
+          extra_digest = None
+          if dedup:
+            extra_digest = dedup_digest(frame, extra_digests[extra_ext])
+            extra_existing = dedup_index.find(self.output_dir, extra_digest)
+            if extra_existing and self.dedup == 'reference': continue
+            if extra_existing and self.linkImage(extra_existing, extra_path):
+              written.append(extra_path)
+              extras_saved += 1
+              if self.catalog: catalogued.append((extra_path, counter))
+              continue
+          extras_saved += 1
+          if parallel:
+            extra_jobs.setdefault(extra_ext, []).append((index, extra_path))
+            if extra_digest: extra_hashes.setdefault(extra_ext, []).append((extra_digest, extra_path))
+          else:
+            if large:
+              self.writeLarge(extra_path, frame, extra_kwargs)
+              future = None
+            elif background:
+              # one Image per encode: Pillow keeps the save() options on the image while it encodes
+              future = submit(extra_path, self.writeImage, extra_path, Image.fromarray(frame), prompt, save_metadata, extra_pnginfo, quality, extra_kwargs)
+              submitted.append((future, [extra_path]))
             else:
-              image_name = f'{counter:0{counter_digits}}{delimiter}{filename}{output_ext}'
+              future = fanout_pool.submit(self.writeImage, extra_path, Image.fromarray(frame), prompt, save_metadata, extra_pnginfo, quality, extra_kwargs)
+              fanout.append(future)
+            if not background: written.append(extra_path)
+            if extra_digest and future is None:
+              dedup_index.add(self.output_dir, extra_digest, extra_path)
+            elif extra_digest:
+              future.add_done_callback(lambda future, digest=extra_digest, image_path=extra_path: future.exception() is None and dedup_index.add(self.output_dir, digest, image_path))
+          if self.catalog: catalogued.append((extra_path, counter))
+        
+        if existing and self.dedup == 'reference':
+          # the main format is not written again: the UI shows the image saved before. Only extra formats saved now use the counter
+          if debug: print(f"debug save_images: {image_name} is {existing}")
+          results.append({ 'filename': os.path.basename(existing), 'subfolder': self.get_subfolder_path(existing, self.output_dir), 'type': self.type})
+          if extras_saved: counter += 1
+          continue
+        
+        linked = existing is not None and self.linkImage(existing, image_path)
+        if linked:
+          written.append(image_path)
+        elif large:
+          self.writeLarge(image_path, frame, encoder_kwargs)
+          written.append(image_path)
+        elif parallel:
+          # encoded all at once after the loop, the order of results does not change
+          jobs.append((index, image_path))
+        elif sequence:
+          if self.async_write:
+            submitted.append((writer.submit(image_path, self.writeSequence, image_path, frames, encoder_kwargs, frame_duration), [image_path]))
           else:
-            image_name = f'{counter:0{counter_digits}}{output_ext}'
+            self.writeSequence(image_path, frames, encoder_kwargs, frame_duration)
+            written.append(image_path)
+        elif background:
+          # blocks only when async_queue_depth images are already waiting
+          future = submit(image_path, self.writeImage, image_path, img, prompt, save_metadata, extra_pnginfo, quality, encoder_kwargs)
+          submitted.append((future, [image_path]))
+          future.add_done_callback(lambda future: future.exception() is None and encoded(future.result()))
+          # known once it is on disk
+          if dedup: future.add_done_callback(lambda future, digest=digest, image_path=image_path: future.exception() is None and dedup_index.add(self.output_dir, digest, image_path))
         else:
-          # issue/48
-          if filename:
-            image_name = f'{filename}{output_ext}'
-          else:
-            image_name = f'{filename_prefix}{output_ext}'
-        
-        image_path = os.path.join(output_path, image_name)
-        self.writeImage(image_path, img, prompt, save_metadata, extra_pnginfo, quality)
+          encoded(self.writeImage(image_path, img, prompt, save_metadata, extra_pnginfo, quality, encoder_kwargs))
+          written.append(image_path)
+          if dedup: dedup_index.add(self.output_dir, digest, image_path)
+        if dedup and parallel and not linked: hashes.append((digest, image_path))
+        if self.catalog: catalogued.append((image_path, counter))
+        timer.lap('write')
         
         if save_job_data != 'disabled' and job_data_per_image:
-          self.save_job_to_json(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, f'{image_name.removesuffix(output_ext)}.json', timestamp)
+          self.save_job_to_json(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, f'{image_name.removesuffix(output_ext)}{job_ext}', timestamp, prompt_index)
+          written.append(os.path.join(output_path, f'{image_name.removesuffix(output_ext)}{job_ext}'))
+          timer.lap('job')
         
         subfolder = self.get_subfolder_path(image_path, self.output_dir)
-        results.append({ 'filename': image_name, 'subfolder': subfolder, 'type': self.type})
+        if image_preview and large:
+          # preview_proxy or not: every step-th pixel is plenty for a preview, the browser would choke on the output itself
+          step = max(max(frame.shape[:2]) // self.preview_proxy_size, 1)
+          preview = self.savePreviewProxy(images_to_uint8(frame[::step, ::step]), image_name, output_ext, force=True)
+        else:
+          preview = self.savePreviewProxy(frame, image_name, output_ext) if (self.preview_proxy and image_preview) else None
+        results.append(preview or { 'filename': image_name, 'subfolder': subfolder, 'type': self.type})
         counter += 1
+        timer.lap('preview')
+      
+      if jobs:
+        if self.async_write:
+          future = writer.submit([image_path for _, image_path in jobs], self.writeImagesParallel, jobs, frames, prompt, save_metadata, extra_pnginfo, quality, encoder_kwargs)
+          submitted.append((future, [image_path for _, image_path in jobs]))
+          if hashes: future.add_done_callback(lambda future: future.exception() is None and [dedup_index.add(self.output_dir, digest, image_path) for digest, image_path in hashes])
+        else:
+          for seconds in self.writeImagesParallel(jobs, frames, prompt, save_metadata, extra_pnginfo, quality, encoder_kwargs):
+            encoded(seconds)
+          written += [image_path for _, image_path in jobs]
+          for digest, image_path in hashes:
+            dedup_index.add(self.output_dir, digest, image_path)
+        timer.lap('write')
+      
+      for extra_ext, extra_kwargs in extras:
+        if extra_ext not in extra_jobs: continue
+        extra_paths = [image_path for _, image_path in extra_jobs[extra_ext]]
+        if self.async_write:
+          submitted.append((writer.submit(extra_paths, self.writeImagesParallel, extra_jobs[extra_ext], frames, prompt, save_metadata, extra_pnginfo, quality, extra_kwargs), extra_paths))
+          if extra_ext in extra_hashes: submitted[-1][0].add_done_callback(lambda future, hashes=extra_hashes[extra_ext]: future.exception() is None and [dedup_index.add(self.output_dir, digest, image_path) for digest, image_path in hashes])
+        else:
+          self.writeImagesParallel(extra_jobs[extra_ext], frames, prompt, save_metadata, extra_pnginfo, quality, extra_kwargs)
+          written += extra_paths
+          for digest, image_path in extra_hashes.get(extra_ext, []):
+            dedup_index.add(self.output_dir, digest, image_path)
+        timer.lap('write')
+      if stream and not self.async_write:
+        wait([future for future, _ in submitted])
+        for future, paths in submitted:
+          future.result()
+          written += paths
+        submitted = list()
+        timer.lap('write')
+      if fanout_pool is not None:
+        try:
+          for future in fanout: future.result()
+        finally:
+          fanout_pool.shutdown(wait=False)
+        timer.lap('write')
       
       if save_job_data != 'disabled' and not job_data_per_image:
-        self.save_job_to_json(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, 'jobs.json', timestamp)
+        self.save_job_to_json(save_job_data, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, output_path, f'jobs{job_ext}', timestamp, prompt_index)
+        written.append(os.path.join(output_path, f'jobs{job_ext}'))
+        timer.lap('job')
+      
+      if catalogued:
+        catalog_row = self.genCatalogRow(frames.shape[2], frames.shape[1], timestamp, prompt, filename_prefix, positive_text_opt, negative_text_opt, job_custom_text, resolution, prompt_index)
+        # async writes: recorded once they land, with their size, and only when they succeed
+        for future, paths in submitted:
+          pending = [(image_path, counter) for image_path, counter in catalogued if image_path in paths]
+          catalogued = [(image_path, counter) for image_path, counter in catalogued if image_path not in paths]
+          if pending: future.add_done_callback(lambda future, pending=pending: future.exception() is None and self.catalogImages(catalog_row, pending))
+        if catalogued: self.catalogImages(catalog_row, catalogued)
+        timer.lap('job')
+      
+      if self.durability == 'fsync+dir':
+        fsync_folders(written)
+        # async writes: once they land
+        for future, paths in submitted:
+          future.add_done_callback(lambda future, paths=paths: future.exception() is None and fsync_folders(paths))
+      # next call gets its counter from counter_index, async writes update it when they land
+      for ext in [output_ext] + [extra_ext for extra_ext, _ in extras]:
+        counter_index.reserve(output_path, self.counter_key(filename, counter_digits, counter_position, ext), counter)
+      counter_index.files_written(written)
     
     except OSError as e:
       print(f"SaveImageExtended {version} error: An error occurred while creating the subfolder or saving the image: {e}")
     else:
+      self.recordMetrics(timer, len(frames), output_ext, resolution)
       if not image_preview:
         results = list()
       return { 'ui': { 'images': results } }
@@ -0,0 +1,56 @@
+import { app } from "../../../scripts/app.js";
+import { api } from "../../../scripts/api.js";
+
+// preview_only: the images stay in the server memory and are shown from /save_image_extended/preview/<key>
+// "Save previews to disk" writes the last ones shown, with their counter at that time
+// archive_format previews come the same way, marked archived: they are already saved in a shard
+
+app.registerExtension({
+	name: "SIEPreviewOnly",
+	async beforeRegisterNodeDef(nodeType, nodeData, app) {
+		if (nodeData.name !== "SaveImageExtended") return;
+
+		const onExecuted = nodeType.prototype.onExecuted;
+		nodeType.prototype.onExecuted = function (message) {
+			const r = onExecuted?.apply(this, arguments);
+			const previews = message?.save_image_extended_previews;
+			if (!previews) return r;
+
+			this.sieKeys = previews.filter((p) => !p.archived).map((p) => p.key);
+			this.imgs = previews.map((p) => {
+				const img = new Image();
+				img.onload = () => app.graph.setDirtyCanvas(true);
+				img.src = api.apiURL(`/save_image_extended/preview/${p.key}`);
+				img.title = p.filename;
+				return img;
+			});
+			this.imageIndex = null;
+			this.setSizeForImage?.();
+			app.graph.setDirtyCanvas(true);
+			return r;
+		};
+
+		const getExtraMenuOptions = nodeType.prototype.getExtraMenuOptions;
+		nodeType.prototype.getExtraMenuOptions = function (_, options) {
+			const r = getExtraMenuOptions?.apply(this, arguments);
+			if (this.sieKeys?.length) {
+				options.unshift({
+					content: "💾 Save previews to disk",
+					callback: async () => {
+						const res = await api.fetchApi("/save_image_extended/preview/persist", {
+							method: "POST",
+							headers: { "Content-Type": "application/json" },
+							body: JSON.stringify({ keys: this.sieKeys }),
+						});
+						if (!res.ok) return;
+						const { images } = await res.json();
+						// saved once: the keys are gone from the server
+						this.sieKeys = null;
+						console.log("🦛 SIE: saved", images.map((i) => `${i.subfolder}/${i.filename}`));
+					},
+				});
+			}
+			return r;
+		};
+	},
+});